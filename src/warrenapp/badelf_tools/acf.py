@@ -2,9 +2,14 @@
 
 from pathlib import Path
 
+import numpy as np
 import pandas
 from pymatgen.io.vasp import Potcar
-from pymatgen.io.vasp.outputs import Chgcar
+
+from warrenapp.badelf_tools.volumetric_io import (
+    find_volumetric_file,
+    read_volumetric_structure,
+)
 
 
 def ACF(directory: Path = None, filename="ACF.dat"):
@@ -23,21 +28,14 @@ def ACF(directory: Path = None, filename="ACF.dat"):
     # just site index.
     headers = ("x", "y", "z", "charge", "min_dist", "atomic_vol")
 
-    # create a list that we will load data into
-    bader_data = []
     # The first 2 lines are header and the final 4 lines are the footer. This is always
     # true so we don't need to iterate through those. The data we want is between the
-    # header and footer so that's what we loop through.
-    for line in lines[2:-4]:
-        # By running strip, we convert the line from a string to a list of
-        # The values are all still strings, so we convert them to int/floats
-        # before saving. I add [1:] because the first value is just '#' which
-        # is site index and we dont need.
-        line_data = [eval(value) for value in line.split()[1:]]
-        # add the line data to our ouput
-        bader_data.append(line_data)
-
-    # convert the list to a pandas dataframe
+    # header and footer. Every row has the site index followed by the 6 values
+    # above, so we parse the whole table at once and drop the first column.
+    bader_data = np.array("".join(lines[2:-4]).split(), dtype=np.float64)
+    bader_data = bader_data.reshape(-1, len(headers) + 1)[:, 1:]
+
+    # convert the array to a pandas dataframe
     dataframe = pandas.DataFrame(
         data=bader_data,
         columns=headers,
@@ -56,8 +54,10 @@ def ACF(directory: Path = None, filename="ACF.dat"):
     # files to be present, such as from a vasp calculation
 
     potcar_filename = directory / "POTCAR"
-    chgcar_filename = directory / "CHGCAR"
-    chgcar_empty_filename = directory / "CHGCAR_empty"  # SPECIAL CASE
+    # the volumetric files may be compressed (e.g. CHGCAR.gz)
+    chgcar_filename = find_volumetric_file(directory / "CHGCAR")
+    # SPECIAL CASE
+    chgcar_empty_filename = find_volumetric_file(directory / "CHGCAR_empty")
 
     # check if the required vasp files are present before doing the workup
     if potcar_filename.exists() and (
@@ -75,9 +75,10 @@ def ACF(directory: Path = None, filename="ACF.dat"):
         # SPECIAL CASE: in scenarios where empty atoms are added to the structure,
         # we should grab that modified structure instead of the one from the POSCAR.
         # the empty file will always take preference
+        # We only need the structure, so we read it from the file header and
+        # never load the grid.
         if chgcar_empty_filename.exists():
-            chgcar = Chgcar.from_file(chgcar_empty_filename)
-            structure = chgcar.structure
+            structure = read_volumetric_structure(chgcar_empty_filename)
             # We typically use helium ("He") as the empty atom, so we will
             # need to add this to our element list for oxidation analysis.
             # We use 0 for electron count because this is an 'empty' atom, and
@@ -85,10 +86,8 @@ def ACF(directory: Path = None, filename="ACF.dat"):
             nelectron_data.update({"He": 0})
 
         # otherwise, grab the structure from the CHGCAR
-        # OPTIMIZE: consider grabbing from the POSCAR or CONTCAR for speed
         else:
-            chgcar = Chgcar.from_file(chgcar_filename)
-            structure = chgcar.structure
+            structure = read_volumetric_structure(chgcar_filename)
 
         # Calculate the oxidation state of each site where it is simply the
         # change in number of electrons associated with it from vasp potcar vs
@@ -7,17 +7,34 @@ Created on Wed Apr 26 13:57:31 2023
 """
 import itertools
 import math
-from math import ceil
-from math import prod as product
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tempfile import TemporaryDirectory
 
 import numpy as np
 import pandas as pd
-from numpy import polyfit
 from pymatgen.analysis.local_env import CrystalNN
-from scipy.interpolate import RegularGridInterpolator
-from scipy.spatial import ConvexHull
+from pymatgen.core.structure import PeriodicNeighbor
+from scipy.optimize import minimize_scalar
+from scipy.spatial import ConvexHull, cKDTree
 from simmate.toolkit import Structure
 
+from warrenapp.badelf_tools.grid_cache import get_cached_grid
+from warrenapp.badelf_tools.interpolation import (
+    get_grid_interpolator,
+    get_worker_interpolator,
+    load_worker_interpolator,
+    write_shared_grid,
+)
+from warrenapp.badelf_tools.lattice import Lattice
+from warrenapp.badelf_tools.plane_table import PlaneTable
+from warrenapp.badelf_tools.planes import get_bounding_planes
+from warrenapp.badelf_tools.site_pairs import get_pair_representatives
+from warrenapp.badelf_tools.volumetric_io import (
+    find_volumetric_file,
+    open_volumetric_file,
+    read_volumetric_grid,
+)
+
 ###############################################################################
 # This module defines functions that are used in the warren lab badelf
 # algorithm
@@ -58,11 +75,8 @@ def get_voxel_from_frac(site, lattice):
     values that transition smoothly when wrapping.
     """
 
-    grid_size = lattice["grid_size"]
-    frac = lattice["coords"][site]
-    voxel_pos = [a * b + 1 for a, b in zip(grid_size, frac)]
     # voxel positions go from 1 to (grid_size + 0.9999)
-    return np.array(voxel_pos)
+    return lattice.coords[site] * lattice.grid_size + 1
 
 
 def get_voxel_from_neigh_CrystalNN(neigh, lattice):
@@ -70,11 +84,8 @@ def get_voxel_from_neigh_CrystalNN(neigh, lattice):
     Gets the voxel coordinate from a neighbor atom object from CrystalNN or
     VoronoiNN
     """
-    grid_size = lattice["grid_size"]
-    frac = neigh["site"].frac_coords
-    voxel_pos = [a * b + 1 for a, b in zip(grid_size, frac)]
     # voxel positions go from 1 to (grid_size + 0.9999)
-    return np.array(voxel_pos)
+    return neigh["site"].frac_coords * lattice.grid_size + 1
 
 
 def get_voxel_from_neigh(neigh, lattice):
@@ -82,48 +93,35 @@ def get_voxel_from_neigh(neigh, lattice):
     Gets the voxel coordinate from a neighbor atom object from CrystalNN or
     VoronoiNN
     """
-    grid_size = lattice["grid_size"]
-    frac = neigh.frac_coords
-    voxel_pos = [a * b + 1 for a, b in zip(grid_size, frac)]
     # voxel positions go from 1 to (grid_size + 0.9999)
-    return np.array(voxel_pos)
+    return neigh.frac_coords * lattice.grid_size + 1
 
 
-def get_frac_from_vox(voxel_position: list, lattice: dict):
+def get_frac_from_vox(voxel_position: list, lattice: Lattice):
     """
     Function that takes in a voxel position and returns the fractional
-    coordinates.
+    coordinates. Also works on an (N,3) array of voxel positions.
     """
-    size = lattice["grid_size"]
-    fa, fb, fc = [((a - 1) / b) for a, b in zip(voxel_position, size)]
-    coords = np.array([fa, fb, fc])
-    return coords
+    return (np.asarray(voxel_position) - 1) / lattice.grid_size
 
 
-def get_real_from_frac(frac_pos, lattice):
+def get_real_from_frac(frac_pos, lattice: Lattice):
     """
-    Function that takes in fractional coordinates and returns real coordinates
+    Function that takes in fractional coordinates and returns real coordinates.
+    Also works on an (N,3) array of fractional coordinates.
     """
-    #!!! round? NOT NECESSARY
-    fa, fb, fc = frac_pos[0], frac_pos[1], frac_pos[2]
-    a, b, c = lattice["a"], lattice["b"], lattice["c"]
-    x = fa * a[0] + fb * b[0] + fc * c[0]
-    y = fa * a[1] + fb * b[1] + fc * c[1]
-    z = fa * a[2] + fb * b[2] + fc * c[2]
-    coords = np.array([x, y, z])
-    return coords
+    return np.dot(frac_pos, lattice.matrix)
 
 
-def get_real_from_vox(voxel_position: list, lattice: dict):
+def get_real_from_vox(voxel_position: list, lattice: Lattice):
     """
     We need to turn voxel_position this into a real space position.
-    First, to get fractional positions, we follow the VASP notation and
-    subtract 1 from pos_vox, then divide by the grid_size.
-    The rest is just standard geometry to get the x,y,z real-space positions.
+    Following the VASP notation, we subtract 1 from pos_vox. The rows of the
+    voxel matrix are the lattice vectors divided by the grid size, so
+    multiplying by it gives the x,y,z real-space positions directly.
+    Also works on an (N,3) array of voxel positions.
     """
-    frac_pos = get_frac_from_vox(voxel_position, lattice)
-    coords = get_real_from_frac(frac_pos, lattice)
-    return coords
+    return np.dot(np.asarray(voxel_position) - 1, lattice.voxel_matrix)
 
 
 def get_number_of_partitions(
@@ -156,36 +154,34 @@ def get_number_of_partitions(
 def get_lattice(partition_file: str):
     """
     This function gets several important things from the lattice defined in
-    the partitioning file
+    the partitioning file and returns them as a Lattice object. The file may
+    be compressed (see open_volumetric_file).
     """
-    lattice = {}
-    lattice["coords"] = []
-    lattice["num_atoms"] = 1000
+    matrix = []
+    coords = []
+    num_atoms = 1000
 
-    with open(partition_file) as f:
+    with open_volumetric_file(partition_file, "r") as f:
         for i, line in enumerate(f):
-            if i == 2:
-                lattice["a"] = [float(x) for x in line.split()]
-            if i == 3:
-                lattice["b"] = [float(x) for x in line.split()]
-            if i == 4:
-                lattice["c"] = [float(x) for x in line.split()]
+            if 2 <= i <= 4:
+                matrix.append([float(x) for x in line.split()])
             if i == 5:
-                lattice["elements"] = line.split()
+                elements = line.split()
             if i == 6:
-                lattice["num_atoms"] = sum([int(x) for x in line.split()])
-                lattice["elements_num"] = [int(x) for x in line.split()]
-            if 8 <= i < 8 + lattice["num_atoms"]:
-                lattice["coords"].append([float(x) for x in line.split()])
-            if i == 9 + lattice["num_atoms"]:
-                lattice["grid_size"] = [int(x) for x in line.split()]
-            if i == 10 + lattice["num_atoms"]:
-                lattice["volume"] = np.dot(
-                    np.cross(lattice["a"], lattice["b"]), lattice["c"]
-                )
-                lattice["lines"] = ceil(product(lattice["grid_size"]) / 10)
+                elements_num = [int(x) for x in line.split()]
+                num_atoms = sum(elements_num)
+            if 8 <= i < 8 + num_atoms:
+                coords.append([float(x) for x in line.split()[:3]])
+            if i == 9 + num_atoms:
+                grid_size = [int(x) for x in line.split()]
                 break
-    return lattice
+    return Lattice(
+        matrix=matrix,
+        coords=coords,
+        grid_size=grid_size,
+        elements=elements,
+        elements_num=elements_num,
+    )
 
 
 def get_closest_neighbors(structure: Structure):
@@ -201,328 +197,572 @@ def get_closest_neighbors(structure: Structure):
     return closest_neighbors
 
 
-def get_26_neighbors(structure):
-    # Get all possible neighbor atoms for each atom within 15 angstroms
-    all_neighbors = structure.get_all_neighbors(15)
-    neighbors26 = []
-    # For each atom, create a df to store the neighbor and its distance
-    # from the atom. Then sort this df by distance and only keep the
-    # 26 closest neighbors
-    for site, neighs in enumerate(all_neighbors):
-        site_df = pd.DataFrame(columns=["neighbor", "distance"])
-        site_object = structure[site]
-        for neigh in neighs:
-            # get distance
-            distance = math.dist(neigh.coords, site_object.coords)
-            # add neighbor, distance pair to df
-            site_df.loc[len(site_df)] = [neigh, distance]
-        # sort by distance and truncate to first 26
-        site_df = site_df.sort_values(by="distance")
-        #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        # Temporarily switching from 26 to 50 nearest planes
-        site_df = site_df.iloc[0:50]
-        #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        # Add the neighbors as a list to the df
-        neighbors26.append(site_df["neighbor"].to_list())
-    return neighbors26
-
-
-def get_grid_axes(grid):
-    """
-    Gets the the possible indices for each dimension of a padded grid.
-    e.g. if the original charge density grid is 20x20x20, this function will
-    return three arrays with integers from 0 to 21.
-    """
-    a = np.linspace(0, grid.shape[0] + 1, grid.shape[0] + 2)
-    b = np.linspace(0, grid.shape[1] + 1, grid.shape[1] + 2)
-    c = np.linspace(0, grid.shape[2] + 1, grid.shape[2] + 2)
-    return a, b, c
+def get_nearest_neighbors(structure: Structure, num_neighbors: int = 50):
+    """
+    Finds the closest periodic images of every site to each site. Returns
+    three arrays:
+        indices: (sites, num_neighbors) index of each neighbor in the structure
+        images: (sites, num_neighbors, 3) lattice translation of each neighbor
+        distances: (sites, num_neighbors) distance to each neighbor in Angstrom
+    Neighbors are sorted by distance. The site itself is not included.
+
+    The periodic images of the sites are put in a KD-tree and searched once.
+    We start with a cutoff that should hold a few more than num_neighbors
+    sites at the density of the structure. If a site doesn't find enough
+    neighbors inside the cutoff (e.g. it sits next to a vacuum layer) the
+    cutoff is doubled and the search is repeated.
+    """
+    # work with the sites wrapped into the cell and add the shift back to
+    # the images at the end
+    cell_shifts = np.floor(structure.frac_coords)
+    frac_coords = structure.frac_coords - cell_shifts
+    matrix = structure.lattice.matrix
+    num_sites = len(frac_coords)
+    # the radius of a sphere holding 1.5 times as many sites as we need
+    site_volume = abs(np.linalg.det(matrix)) / num_sites
+    cutoff = (1.5 * num_neighbors * site_volume * 3 / (4 * np.pi)) ** (1 / 3)
+    # The distance between lattice planes in each direction. We need enough
+    # images that every site has the full sphere around it filled in.
+    plane_spacing = 1 / np.linalg.norm(np.linalg.inv(matrix), axis=0)
+    while True:
+        image_range = np.ceil(cutoff / plane_spacing).astype(int) + 1
+        images = np.array(
+            list(itertools.product(*[range(-n, n + 1) for n in image_range])),
+            dtype=np.float64,
+        )
+        image_frac_coords = (
+            frac_coords[np.newaxis, :, :] + images[:, np.newaxis, :]
+        ).reshape(-1, 3)
+        tree = cKDTree(image_frac_coords @ matrix)
+        # The site itself is one of the points found. Missing points past the
+        # cutoff are given an infinite distance.
+        distances, points = tree.query(
+            frac_coords @ matrix, k=num_neighbors + 1, distance_upper_bound=cutoff
+        )
+        if np.all(np.isfinite(distances)):
+            break
+        cutoff *= 2
+
+    # remove each site from its own list of neighbors. It is always the
+    # closest point, unless two sites sit on top of each other.
+    zero_image = np.flatnonzero(np.all(images == 0, axis=1))[0]
+    keep = points != zero_image * num_sites + np.arange(num_sites)[:, np.newaxis]
+    # sites that somehow didn't find themselves drop their furthest neighbor
+    keep[keep.sum(axis=1) > num_neighbors, -1] = False
+    points = points[keep].reshape(num_sites, num_neighbors)
+    distances = distances[keep].reshape(num_sites, num_neighbors)
+    indices = points % num_sites
+    # the images are relative to the sites as they are in the structure
+    images = (
+        images[points // num_sites]
+        + cell_shifts[:, np.newaxis, :]
+        - cell_shifts[indices]
+    )
+    return indices, images, distances
 
 
-def get_grid_axes_large_pad(grid, size):
+def get_26_neighbors(structure, num_neighbors: int = 50):
     """
-    Gets the the possible indices for each dimension of a padded grid.
-    e.g. if the original charge density grid is 20x20x20, this function will
-    return three arrays with integers from 0 to 21.
+    Gets the closest neighbors of each site as lists of PeriodicNeighbor
+    objects sorted by distance (see get_nearest_neighbors).
     """
-    a = np.linspace(0, grid.shape[0] + (size - 1) * 2 + 1, grid.shape[0] + size * 2)
-    b = np.linspace(0, grid.shape[1] + (size - 1) * 2 + 1, grid.shape[1] + size * 2)
-    c = np.linspace(0, grid.shape[2] + (size - 1) * 2 + 1, grid.shape[2] + size * 2)
-    return a, b, c
+    #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+    # Temporarily switching from 26 to 50 nearest planes
+    #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+    indices, images, distances = get_nearest_neighbors(structure, num_neighbors)
+    neighbors26 = []
+    for site_indices, site_images, site_distances in zip(indices, images, distances):
+        neighs = []
+        for index, image, distance in zip(site_indices, site_images, site_distances):
+            neigh_site = structure[index]
+            neighs.append(
+                PeriodicNeighbor(
+                    species=neigh_site.species,
+                    coords=neigh_site.frac_coords + image,
+                    lattice=structure.lattice,
+                    properties=neigh_site.properties,
+                    nn_distance=distance,
+                    index=index,
+                    image=tuple(image),
+                )
+            )
+        neighbors26.append(neighs)
+    return neighbors26
 
 
 def get_partitioning_grid(
     partition_file: str,
-    lattice: dict,
+    lattice: Lattice,
+    use_cache: bool = True,
+    nthreads: int = 1,
 ):
     """
-    Loads in the partitioning file (usualy ELFCAR) into a 3D numpy array
+    Loads in the partitioning file (usualy ELFCAR) into a 3D numpy array.
+    If use_cache is True, the grid is read through a binary sidecar file
+    (see grid_cache.py) and is returned as a read-only memory map after the
+    first time the file is parsed. The text is parsed on nthreads threads.
+    Compressed files (e.g. ELFCAR.gz) are decompressed as they are read.
     """
-    try:
-        grid = np.loadtxt(
-            partition_file,
-            skiprows=10 + lattice["num_atoms"],
-            max_rows=lattice["lines"],
-        ).ravel()
-    except:
-        grid1 = np.loadtxt(
-            partition_file,
-            skiprows=10 + lattice["num_atoms"],
-            max_rows=lattice["lines"] - 1,
-        ).ravel()
-        grid2 = np.loadtxt(
+    partition_file = find_volumetric_file(partition_file)
+    if use_cache:
+        return get_cached_grid(
             partition_file,
-            skiprows=10 + lattice["num_atoms"] + lattice["lines"] - 1,
-            max_rows=1,
-        ).ravel()
-        grid = np.concatenate((grid1, grid2))
-
-    grid = grid.ravel().reshape(lattice["grid_size"], order="F")
-    return grid
+            loader=get_partitioning_grid,
+            kind="partitioning",
+            grid_size=lattice.grid_size,
+            lattice=lattice,
+            use_cache=False,
+            nthreads=nthreads,
+        )
+    return read_volumetric_grid(partition_file, lattice, nthreads=nthreads)
 
 
 def get_charge_density_grid(
     charge_file: str,
-    lattice: dict,
+    lattice: Lattice,
+    use_cache: bool = True,
+    nthreads: int = 1,
 ):
     """
-    Loads the charge density from the charge file (CHGCAR) into a 3D numpy array
+    Loads the charge density from the charge file (CHGCAR) into a 3D numpy array.
+    If use_cache is True, the grid is read through a binary sidecar file
+    (see grid_cache.py) and is returned as a read-only memory map after the
+    first time the file is parsed. The text is parsed on nthreads threads.
+    Compressed files (e.g. ELFCAR.gz) are decompressed as they are read.
     """
-    try:
-        chg1 = np.loadtxt(
-            charge_file,
-            skiprows=10 + lattice["num_atoms"],
-            max_rows=lattice["lines"] * 2 - 1,
-        ).ravel()
-        chg2 = np.loadtxt(
-            charge_file,
-            skiprows=10 + lattice["num_atoms"] + lattice["lines"] * 2 - 1,
-            max_rows=1,
-        ).ravel()
-        chg = np.concatenate((chg1, chg2))
-    except:
-        chg1 = np.loadtxt(
-            charge_file,
-            skiprows=10 + lattice["num_atoms"],
-            max_rows=lattice["lines"] * 2 - 2,
-        ).ravel()
-        chg2 = np.loadtxt(
+    charge_file = find_volumetric_file(charge_file)
+    if use_cache:
+        return get_cached_grid(
             charge_file,
-            skiprows=10 + lattice["num_atoms"] + lattice["lines"] * 2 - 2,
-            max_rows=1,
-        ).ravel()
-        chg = np.concatenate((chg1, chg2))
+            loader=get_charge_density_grid,
+            kind="charge",
+            grid_size=lattice.grid_size,
+            lattice=lattice,
+            use_cache=False,
+            nthreads=nthreads,
+        )
+    return read_volumetric_grid(charge_file, lattice, nthreads=nthreads)
+
+
+def get_partitioning_line_positions(
+    site_positions, neigh_positions, grid_size, steps: int = 200
+):
+    """
+    Finds the lines of voxel positions between many pairs of atom sites at
+    once. site_positions and neigh_positions are (pairs, 3) arrays of voxel
+    positions. Returns a (pairs, steps + 1, 3) array of positions wrapped back
+    into the cell.
+    """
+    site_positions = np.asarray(site_positions, dtype=np.float64).reshape(-1, 3)
+    neigh_positions = np.asarray(neigh_positions, dtype=np.float64).reshape(-1, 3)
+    # get the points along each connecting line
+    line_fracs = np.linspace(0, 1, steps + 1)
+    slopes = neigh_positions - site_positions
+    positions = (
+        site_positions[:, np.newaxis, :]
+        + line_fracs[np.newaxis, :, np.newaxis] * slopes[:, np.newaxis, :]
+    )
+    # Wrap values back into cell
+    # We must do (a-1) to shift the voxel index (1 to grid_max+1) onto a
+    # normal grid, (0 to grid_max), then do the wrapping function (%), then
+    # shift back onto the VASP voxel index.
+    return np.mod(positions - 1, grid_size) + 1
 
-    chg = chg.reshape(lattice["grid_size"], order="F")
-    return chg
 
+def get_line_steps(
+    site_positions, neigh_positions, points_per_voxel: float = 5, min_steps: int = 20
+):
+    """
+    Chooses the number of steps for the line between each pair of atom sites
+    from its length in voxels. site_positions and neigh_positions are
+    (pairs, 3) arrays of voxel positions.
 
-def get_partitioning_line_rough(site_pos, neigh_pos, grid):
+    Each line gets points_per_voxel points for each voxel of its length, but
+    never fewer than min_steps steps. A fixed number of steps oversamples
+    short bonds on fine grids and undersamples long bonds on coarse ones.
+    With the default of 5 points per voxel, the 7 points used to fit each
+    minimum (see get_lines_quadratic_min) span a little more than a voxel.
+    Denser lines start to pick up the small wiggles that the linear
+    interpolation has inside each voxel as extra minima.
     """
-    Finds a line of voxel positions between two atom sites and then finds the value
-    of the partitioning grid at each of these positions. The values are found
-    using an interpolation function defined using SciPy's RegularGridInterpeter
-    using the 'cubic' method.
-    """
-    steps = 200
-    slope = [b - a for a, b in zip(site_pos, neigh_pos)]
-    slope_increment = [float(x) / steps for x in slope]
-
-    # get a list of points along the connecting line
-    position = site_pos
-    line = [position]
-    for i in range(steps):
-        # move position by slope_increment
-        position = [float(a + b) for a, b in zip(position, slope_increment)]
-
-        # Wrap values back into cell
-        # We must do (a-1) to shift the voxel index (1 to grid_max+1) onto a
-        # normal grid, (0 to grid_max), then do the wrapping function (%), then
-        # shift back onto the VASP voxel index.
-        position = [
-            round((float(((a - 1) % b) + 1)), 12) for a, b in zip(position, grid.shape)
-        ]
+    site_positions = np.asarray(site_positions, dtype=np.float64).reshape(-1, 3)
+    neigh_positions = np.asarray(neigh_positions, dtype=np.float64).reshape(-1, 3)
+    line_voxels = np.linalg.norm(neigh_positions - site_positions, axis=1)
+    steps = np.ceil(points_per_voxel * line_voxels).astype(int)
+    return np.maximum(steps, min_steps)
 
-        line.append(position)
 
-    # The partitioning uses a padded grid and grid interpolation to find the
-    # location of dividing planes.
-    padded = np.pad(grid, 1, mode="wrap")
+def get_partitioning_lines(site_positions, neigh_positions, grid, steps: int = 200):
+    """
+    Finds the lines of voxel positions between many pairs of atom sites at once
+    and the value of the partitioning grid at each position. Returns the
+    positions as a (pairs, steps + 1, 3) array (see
+    get_partitioning_line_positions) and the values as a (pairs, steps + 1)
+    array.
 
+    The values are found with linear interpolation in a single call for all
+    of the lines. grid can be the partitioning grid or a
+    PeriodicGridInterpolator built from it.
+    """
+    interpolator = get_grid_interpolator(grid)
+    positions = get_partitioning_line_positions(
+        site_positions, neigh_positions, interpolator.grid_size, steps
+    )
     # interpolate grid to find values that lie between voxels. This is done
     # with a cruder interpolation here and then the area close to the minimum
     # is examened more closely with a more rigorous interpolation in
-    # get_line_frac_min
-    a, b, c = get_grid_axes(grid)
-    fn = RegularGridInterpolator((a, b, c), padded, method="linear")
-    # get a list of the ELF values along the line
-    values = []
-
-    for pos in line:
-        adjusted_pos = [x for x in pos]
-        value = float(fn(adjusted_pos))
-        values.append(value)
-    return line, values
+    # get_line_frac_min_fine
+    values = interpolator.linear(positions)
+    return positions, values
 
 
-def get_line_frac_min_rough(values, rough_partitioning=False):
+def get_partitioning_line_rough(site_pos, neigh_pos, grid, steps: int = None):
     """
-    Finds the minimum point of a list of values along a line, then returns the
-    fractional position of this values position along the line.
-    """
-    # minima function gives all local minima along the values
-    minima = [
-        [i, y]
-        for i, y in enumerate(values)
-        if ((i == 0) or (values[i - 1] >= y))
-        and ((i == len(values) - 1) or (y < values[i + 1]))
-    ]
-
-    # then we grab the local minima closest to the midpoint of the values
-    midpoint = len(values) / 2
-    differences = []
-    for pos, val in minima:
-        diff = abs(pos - midpoint)
-        differences.append(diff)
-    min_pos = differences.index(min(differences))
-    global_min_pos = minima[min_pos]
+    Finds a line of voxel positions between two atom sites and then finds the value
+    of the partitioning grid at each of these positions. This is
+    get_partitioning_lines for a single pair. If steps isn't given it is
+    chosen from the voxels the line crosses (see get_line_steps).
+    """
+    if steps is None:
+        steps = get_line_steps([site_pos], [neigh_pos])[0]
+    positions, values = get_partitioning_lines([site_pos], [neigh_pos], grid, steps)
+    return positions[0].tolist(), values[0].tolist()
+
+
+def get_lines_frac_min(values, rough_partitioning=False, target_fracs=None):
+    """
+    Finds the minimum point along many lines at once. values is a
+    (lines, points) array. Returns arrays with the index, value and fractional
+    position of the minimum of each line.
+
+    Of all the local minima along a line, we take the one closest to the
+    midpoint. If rough_partitioning is True, a quadratic is fit to the 7
+    points around that minimum to find its position between points.
+
+    target_fracs is an optional array with the fractional position that each
+    line's minimum is expected at (see get_pair_radius_fracs). The local
+    minimum closest to it is taken instead of the one closest to the
+    midpoint. Lines with a target of NaN still use the midpoint. Values of
+    NaN (e.g. outside of a search window) are never minima.
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    num_lines, num_points = values.shape
+    lines = np.arange(num_lines)
+    # find all local minima along the values
+    is_minimum = np.ones(values.shape, dtype=bool)
+    is_minimum[:, 1:] &= values[:, :-1] >= values[:, 1:]
+    is_minimum[:, :-1] &= values[:, :-1] < values[:, 1:]
+
+    # then we grab the local minima closest to the midpoint of the values.
+    # argmin takes the first if two are equally close.
+    midpoint = num_points / 2
+    if target_fracs is not None:
+        target_fracs = np.asarray(target_fracs, dtype=np.float64)
+        midpoint = np.where(
+            np.isnan(target_fracs), midpoint, target_fracs * (num_points - 1)
+        )[:, np.newaxis]
+    differences = np.where(is_minimum, np.abs(np.arange(num_points) - midpoint), np.inf)
+    min_index = np.argmin(differences, axis=1)
+    min_value = values[lines, min_index]
 
     # If we have a high enough voxel resolution we only want to run the rough
     # interpolation. If that's the case we want to do a polynomial fit here
     # to ensure that we have the correct position
     if rough_partitioning:
-        # Get the section of the line surrounding the minimum to perform a fit
-        poly_line_section = values[global_min_pos[0] - 3 : global_min_pos[0] + 4]
-        poly_line_x = [i for i in range(global_min_pos[0] - 3, global_min_pos[0] + 4)]
-        # get the polynomial fit
-        try:
-            a, b, c = polyfit(poly_line_x, poly_line_section, 2)
-            # find the minimum and change the values of the global_min_pos list
-            x = -b / (2 * a)
-            global_min_pos[0] = x
-            global_min_pos[1] = np.polyval(np.array([a, b, c]), x)
-        except:
-            pass
+        min_index, min_value, fitted = get_lines_quadratic_min(
+            values, min_index, min_value
+        )
 
-    global_min_pos.append(global_min_pos[0] / (len(values) - 1))
-    return global_min_pos
+    min_frac = min_index / (num_points - 1)
+    return min_index, min_value, min_frac
 
 
-def get_line_frac_min_fine(elf_pos, elf_min_index, grid):
-    # !!! We need more padding for the more rigorous interpolation to get the same
-    # results.
-    amount_to_pad = 10  # int((len(grid[0])+len(grid[1])+len(grid[2]))/6)
+def get_lines_have_minimum(min_index, steps, edge_fraction: float = 0.015):
+    """
+    Checks that the minimum of each line is away from the ends of the line.
+    min_index is the index of the minimum point of each line (see
+    get_lines_frac_min) and steps the number of steps along the lines.
 
-    padded = np.pad(grid, amount_to_pad, mode="wrap")
+    A minimum within edge_fraction of the length of the line from either end
+    (rounded to whole points) is not a real minimum between the two sites.
+    The quadratic fit in get_lines_quadratic_min also needs 3 points on
+    either side of the minimum, so minima closer to the ends than this are
+    never allowed.
+    """
+    edge_points = np.maximum(np.round(edge_fraction * np.asarray(steps)), 3)
+    min_index = np.asarray(min_index)
+    return (min_index >= edge_points) & (min_index <= steps - edge_points)
 
-    # interpolate the grid with a more rigorous method to find more exact value
-    # for the plane.
-    a, b, c = get_grid_axes_large_pad(grid, amount_to_pad)
-    fn = RegularGridInterpolator((a, b, c), padded, method="cubic")
 
-    # create variables for if the line needs to be shifted from what the
-    # rough partitioning found
-    centered = False
-    amount_to_shift = 0
-    attempts = 0
+def get_pair_radius_fracs(
+    lattice: Lattice, pair_sites, pair_neigh_sites, element_radii: dict
+):
+    """
+    Gets the fractional position along each site-neighbor line where the
+    minimum is expected from the radii of the two elements. element_radii is
+    a dictionary of radii by element, e.g. the BadELF radii from
+    get_max_radius or tabulated ionic radii. The minimum is expected to split
+    the bond in the ratio of the two radii, r_site / (r_site + r_neigh).
 
-    try:
-        while centered == False:
-            if attempts == 5:
-                print(
-                    """
-                          Failed to find minimum with quick method. Switching
-                          to intensive.
-                          """
-                )
-                raise Exception()
-            else:
-                attempts += 1
-            # If the position wasn't centered previously, we need to shift
-            # the index
-            elf_min_index = elf_min_index + amount_to_shift
-            line_section = elf_pos[elf_min_index - 3 : elf_min_index + 4]
-            line_section_x = [i for i in range(elf_min_index - 3, elf_min_index + 4)]
-
-            values_fine = []
-            # Get the list of values from the interpolated grid
-            for pos in line_section:
-                new_pos = [i + amount_to_pad - 1 for i in pos]
-                value_fine = float(fn(new_pos))
-                values_fine.append(value_fine)
-
-            # Find the minimum value of this line as well as the index for this value's
-            # position.
-            minimum_value = min(values_fine)
-            min_pos = values_fine.index(minimum_value)  # + global_min_pos[0]-5
-
-            if min_pos == 4:
-                # Our line is centered and we can move on
-                print("centered")
-                centered = True
-            else:
-                # Our line is not centered and we need to adjust it
-                amount_to_shift = min_pos - 4
-                print(f"not centered. Shifting {amount_to_shift}")
+    Returns NaN for pairs where either element has no radius (or a radius
+    of 0, which get_max_radius gives when it can't find one).
+    """
+    site_species = np.repeat(lattice.elements, lattice.elements_num)
+    radii = np.array(
+        [element_radii.get(species, 0) for species in site_species], dtype=np.float64
+    )
+    site_radii = radii[np.asarray(pair_sites, dtype=int)]
+    neigh_radii = radii[np.asarray(pair_neigh_sites, dtype=int)]
+    has_radii = (site_radii > 0) & (neigh_radii > 0)
+    radius_fracs = np.full(len(site_radii), np.nan)
+    radius_fracs[has_radii] = site_radii[has_radii] / (
+        site_radii[has_radii] + neigh_radii[has_radii]
+    )
+    return radius_fracs
+
+
+def get_window_line_values(positions, grid, window_fracs, window: float = 0.1):
+    """
+    Finds the values of the partitioning grid along many lines, but only in a
+    window around the fractional position where each line's minimum is
+    expected (see get_pair_radius_fracs). positions is a (lines, points, 3)
+    array of positions along the lines and window the half width of the
+    window as a fraction of the line. Points outside of the window are given
+    a value of NaN.
+
+    Lines with a window_frac of NaN are sampled in full. So are lines with no
+    minimum at least 3 points inside their window, as the radii were a poor
+    guess for these. Returns the values and an array that is True for the
+    lines that were only sampled in their window.
+    """
+    interpolator = get_grid_interpolator(grid)
+    num_lines, num_points, _ = positions.shape
+    steps = num_points - 1
+    window_fracs = np.asarray(window_fracs, dtype=np.float64)
+    windowed = ~np.isnan(window_fracs)
+    window_start = np.clip(np.floor((window_fracs - window) * steps), 0, steps)
+    window_end = np.clip(np.ceil((window_fracs + window) * steps), 0, steps)
+    indices = np.arange(num_points)
+    in_window = (indices >= window_start[:, np.newaxis]) & (
+        indices <= window_end[:, np.newaxis]
+    )
+    in_window[~windowed] = True
+    values = np.full((num_lines, num_points), np.nan)
+    values[in_window] = interpolator.linear(positions[in_window])
+
+    # check that there is a minimum far enough inside each window that the
+    # quadratic fit doesn't reach past it
+    min_index, min_value, min_frac = get_lines_frac_min(
+        values, target_fracs=window_fracs
+    )
+    found = (
+        np.isfinite(min_value)
+        & (min_index >= window_start + 3)
+        & (min_index <= window_end - 3)
+    )
+    missed = windowed & ~found
+    values[missed] = interpolator.linear(positions[missed])
+    windowed &= ~missed
+    return values, windowed
+
+
+def get_lines_quadratic_min(values, min_index, min_value):
+    """
+    Fits a quadratic to the 7 points around the minimum of each line and
+    moves the minimum to the vertex of the fit. values is a (lines, points)
+    array and min_index/min_value the index and value of the minimum point of
+    each line (see get_lines_frac_min).
+
+    Returns the new index (as a float) and value of each minimum and an array
+    that is True for the lines that were fit. Minima within 3 points of the
+    end of their line and flat fits are left where they are.
+    """
+    num_lines, num_points = values.shape
+    lines = np.arange(num_lines)
+    min_index = np.asarray(min_index).astype(np.float64)
+    min_value = np.array(min_value, dtype=np.float64)
+    offsets = np.arange(-3, 4)
+    # We can only fit minima with 3 points on either side
+    can_fit = (min_index >= 3) & (min_index <= num_points - 4)
+    fit_lines = lines[can_fit]
+    fit_index = min_index[can_fit].astype(int)
+    line_sections = values[fit_lines[:, np.newaxis], fit_index[:, np.newaxis] + offsets]
+    # The least squares fit of a*x^2 + b*x + c to the same 7 offsets is the
+    # same linear map for every line, so we fit all sections at once.
+    fit_matrix = np.linalg.pinv(np.vander(offsets, 3))
+    a, b, c = fit_matrix @ line_sections.T
+    # find the minimum of each fit. A flat fit has no minimum.
+    has_vertex = (a != 0) & np.isfinite(a)
+    x = -b[has_vertex] / (2 * a[has_vertex])
+    fit_lines = fit_lines[has_vertex]
+    min_index[fit_lines] = fit_index[has_vertex] + x
+    min_value[fit_lines] = a[has_vertex] * x**2 + b[has_vertex] * x + c[has_vertex]
+    fitted = np.zeros(num_lines, dtype=bool)
+    fitted[fit_lines] = True
+    return min_index, min_value, fitted
+
+
+def get_lines_cubic_step(
+    site_positions, neigh_positions, min_index, grid, num_points, width=1.0
+):
+    """
+    Takes one parabolic step towards the minimum of the cubic interpolation
+    along many lines at once. The cubic interpolation is found at min_index
+    and width points on either side of it along each line, and the minimum is
+    moved to the vertex of the parabola through these three values.
+    site_positions and neigh_positions are the (lines, 3) voxel positions at
+    the ends of each line and num_points the number of points along them.
+
+    Returns the new index and value of each minimum and an array that is True
+    for the lines where the step could be taken. The step can't be taken if
+    the three values don't curve upwards or if the vertex is further than
+    width points away.
+
+    This is only three values of the cubic interpolation per line, so it is
+    found for every line in one call. How far the step moves the minimum is a
+    good estimate of how far the full search in get_line_frac_min_fine would
+    move it.
+    """
+    interpolator = get_grid_interpolator(grid)
+    site_positions = np.asarray(site_positions, dtype=np.float64).reshape(-1, 3)
+    slopes = np.asarray(neigh_positions, dtype=np.float64).reshape(-1, 3)
+    slopes = slopes - site_positions
+    min_index = np.asarray(min_index, dtype=np.float64)
+    # the positions don't need to be wrapped into the cell, the interpolator
+    # wraps them itself
+    step_indices = min_index[:, np.newaxis] + np.array([-width, 0, width])
+    line_fracs = step_indices / (num_points - 1)
+    positions = (
+        site_positions[:, np.newaxis, :]
+        + line_fracs[:, :, np.newaxis] * slopes[:, np.newaxis, :]
+    )
+    lower, middle, upper = interpolator.cubic(positions).T
+    curvature = lower - 2 * middle + upper
+    stepped = curvature > 0
+    x = np.zeros(len(min_index))
+    x[stepped] = width * (lower - upper)[stepped] / (2 * curvature[stepped])
+    stepped &= np.abs(x) <= width
+    x[~stepped] = 0
+    # the value at the vertex of the parabola
+    step_value = middle + (upper - lower) / (2 * width) * x
+    step_value += curvature / (2 * width**2) * x**2
+    return min_index + x, np.where(stepped, step_value, middle), stepped
 
-    except:
-        # The above sometimes fails because the linear fitting gives a guess
-        # for the minimum that isn't close. To handle this we treat these
-        # situations rigorously
-        values = []
-
-        # Get the ELF value for every position in the line.
-        for pos in elf_pos:
-            new_pos = [i + amount_to_pad - 1 for i in pos]
-            value = float(fn(new_pos))
-            values.append(value)
-
-        # Get a list of all of the minima along the line
-        minima = [
-            [i, y]
-            for i, y in enumerate(values)
-            if ((i == 0) or (values[i - 1] >= y))
-            and ((i == len(values) - 1) or (y < values[i + 1]))
-        ]
 
-        # then we grab the local minima closest to the midpoint of the line
-        midpoint = len(values) / 2
-        differences = []
-        for pos, val in minima:
-            diff = abs(pos - midpoint)
-            differences.append(diff)
-        min_pos = differences.index(min(differences))
-        global_min = minima[min_pos]
-
-        # now we want a small section of the line surrounding the minimum
-        values_fine = values[global_min[0] - 3 : global_min[0] + 4]
-        line_section_x = [i for i in range(global_min[0] - 3, global_min[0] + 4)]
-
-    # now that we've found the values surrounding the minimum of our line,
-    # we can fit these values to a 2nd degree polynomial and solve for its
-    # minimum point
-    try:
-        d, e, f = polyfit(line_section_x, values_fine, 2)
-    except:
-        print(min_pos)
-        print(minimum_value)
-        print(values_fine)
-        print(line_section_x)
-        # print(values[global_min[0]-3: global_min[0]+4])
-    x = -e / (2 * d)
-    elf_min_index_new = x
-    elf_min_value_new = np.polyval(np.array([d, e, f]), x)
-    # Redefine the global minimum position with the new interpolated line.
-    # global_min_pos[0] = global_min_pos[0]/(len(line)-1)
-
-    # I may want to add the quadratic fitting back here.
-    # Get the position along the line as a fraction
+def get_line_frac_min_rough(values, rough_partitioning=False):
+    """
+    Finds the minimum point of a list of values along a line, then returns the
+    fractional position of this values position along the line. This is
+    get_lines_frac_min for a single line.
+    """
+    min_index, min_value, min_frac = get_lines_frac_min(
+        [values], rough_partitioning=rough_partitioning
+    )
+    return [min_index[0].item(), min_value[0].item(), min_frac[0].item()]
 
-    #!!! Round? NOT NECESSARY
-    elf_min_frac_new = elf_min_index_new / (len(elf_pos) - 1)
+
+def get_reversed_line_min(min_index, min_value, min_frac, num_points):
+    """
+    Converts the minimum of a line into the minimum of the same line walked
+    in the opposite direction (i.e. from the neighbor back to the site).
+    Works on single values or arrays of them.
+    """
+    return num_points - 1 - min_index, min_value, 1 - min_frac
+
+
+def get_line_frac_min_fine(elf_pos, elf_min_index, grid, search_width=3):
+    """
+    Refines the minimum along a line with the cubic interpolation of the
+    grid. elf_pos is the list of voxel positions along the line and
+    elf_min_index the index of the rough minimum. Returns the index, value and
+    fractional position of the refined minimum. The index is a float
+    measured in points along the line.
+
+    A coarse scan of the cubic interpolation at the points around the rough
+    minimum picks the point to start from. The minimum is then bracketed by
+    the points on either side of it and found with a bounded Brent search.
+    If there is no minimum within search_width points of the rough minimum,
+    None is returned so that the rough minimum is used instead.
+    """
+    # interpolate the grid with a more rigorous method to find more exact value
+    # for the plane. grid can be the partitioning grid or a
+    # PeriodicGridInterpolator, which only finds its spline coefficients once.
+    interpolator = get_grid_interpolator(grid)
+    elf_pos = np.asarray(elf_pos, dtype=np.float64)
+    num_points = len(elf_pos)
+    elf_min_index = int(elf_min_index)
+    # The positions are wrapped into the cell, so we get the step between
+    # points from two neighboring points and unwrap it.
+    step = elf_pos[1] - elf_pos[0]
+    step -= interpolator.grid_size * np.round(step / interpolator.grid_size)
+
+    def get_line_positions(indices):
+        indices = np.asarray(indices, dtype=np.float64)
+        return elf_pos[elf_min_index] + np.multiply.outer(indices - elf_min_index, step)
+
+    # coarse scan around the rough minimum. We scan one point further than
+    # the search width so that a minimum near the edge is still bracketed.
+    scan_indices = np.arange(
+        max(elf_min_index - search_width - 1, 0),
+        min(elf_min_index + search_width + 1, num_points - 1) + 1,
+    )
+    scan_values = interpolator.cubic(get_line_positions(scan_indices))
+    lowest = int(np.argmin(scan_values))
+    if lowest == 0 or lowest == len(scan_indices) - 1:
+        return None
+
+    # bracket the minimum with the points on either side of the lowest point
+    result = minimize_scalar(
+        lambda index: interpolator.cubic(get_line_positions(index)),
+        bounds=(scan_indices[lowest - 1], scan_indices[lowest + 1]),
+        method="bounded",
+        options={"xatol": 1e-6},
+    )
+    elf_min_index_new = float(result.x)
+    if abs(elf_min_index_new - elf_min_index) > search_width:
+        return None
+    elf_min_value_new = float(result.fun)
+    elf_min_frac_new = elf_min_index_new / (num_points - 1)
     return elf_min_index_new, elf_min_value_new, elf_min_frac_new
 
 
+def get_lines_refined_min(
+    values,
+    site_positions,
+    neigh_positions,
+    min_index,
+    min_value,
+    grid,
+    point_length,
+    refine_tolerance: float,
+):
+    """
+    Decides which of the minima along many lines need to be searched for
+    with get_line_frac_min_fine. values is the (lines, points) array of
+    values along the lines and min_index/min_value the minimum point of each
+    (see get_lines_frac_min). point_length is the distance between points
+    along each line in Angstrom.
+
+    Each minimum is fit with a quadratic (see get_lines_quadratic_min) and
+    then moved with one step on the cubic interpolation (see
+    get_lines_cubic_step). The step is a close estimate of how far the full
+    search would move the minimum, so where it is less than refine_tolerance
+    we keep the stepped minimum. Returns the new index and value of each
+    minimum and an array that is True for the lines that still need the full
+    search. Those lines keep the minimum point they started with.
+    """
+    num_points = np.shape(values)[1]
+    fit_index, fit_value, fitted = get_lines_quadratic_min(values, min_index, min_value)
+    step_index, step_value, stepped = get_lines_cubic_step(
+        site_positions, neigh_positions, fit_index, grid, num_points
+    )
+    step_shift = np.abs(step_index - fit_index) * point_length
+    accepted = fitted & stepped & (step_shift <= refine_tolerance)
+    min_index = np.where(accepted, step_index, min_index)
+    min_value = np.where(accepted, step_value, min_value)
+    return min_index, min_value, ~accepted
+
+
 def get_position_from_min(elf_min_frac, site_pos, neigh_pos):
     """
     Gives the voxel position/coords for the minimum along a partitioning line
@@ -552,9 +792,8 @@ def get_unit_vector(site_pos, neigh_pos, lattice):
     # we want the normal vector to be unit vector because later on we
     # will use this information to get the distance of a voxel from
     # the plane.
-    normal_vector = [(b - a) for a, b in zip(real_site_pos, real_neigh_pos)]
-    unit_vector = [(x / np.linalg.norm(normal_vector)) for x in normal_vector]
-    return np.array(unit_vector)
+    normal_vector = real_neigh_pos - real_site_pos
+    return normal_vector / np.linalg.norm(normal_vector)
 
 
 def get_plane_sign(point, unit_vector, site_pos, lattice):
@@ -563,11 +802,10 @@ def get_plane_sign(point, unit_vector, site_pos, lattice):
     be negative for an atoms position compared with a plane dividing it from
     other atoms.
     """
-    # get all of the points in cartesian coordinates
-    x, y, z = get_real_from_vox(site_pos, lattice)
-    a, b, c = unit_vector
-    x1, y1, z1 = point
-    value_of_plane_equation = a * (x - x1) + b * (y - y1) + c * (z - z1)
+    # get the point in cartesian coordinates and plug it into the plane
+    # equation a(x-x1) + b(y-y1) + c(z-z1)
+    real_pos = get_real_from_vox(site_pos, lattice)
+    value_of_plane_equation = float(np.dot(unit_vector, real_pos - point))
     # get the distance of the point from the plane with some allowance of error.
     if value_of_plane_equation > 1e-6:
         return "positive", abs(value_of_plane_equation)
@@ -583,12 +821,11 @@ def get_radius(point, site_pos, lattice):
     between it and another atom.
     """
     real_site_pos = get_real_from_vox(site_pos, lattice)
-    radius = sum([(b - a) ** 2 for a, b in zip(real_site_pos, point)]) ** (0.5)
-    return radius
+    return np.linalg.norm(point - real_site_pos)
 
 
 def get_site_neighbor_results_rough(
-    site_index, neigh, lattice: dict, site_pos: dict, grid, rough_partitioning=False
+    site_index, neigh, lattice: Lattice, site_pos: dict, grid, rough_partitioning=False
 ):
     """
     Function for getting the line, plane, and other information between a site
@@ -610,7 +847,7 @@ def get_site_neighbor_results_rough(
     # For systems with considerable electron localization between atoms
     # (ex. covalent systems) sometimes no minimum will be found except at the
     # edges. In these cases, this algorithm will not work and we want to stop
-    if elf_min_index in [0, 1, 2, 198, 199, 200]:
+    if not get_lines_have_minimum(elf_min_index, len(elf_values_rough) - 1):
         raise Exception(
             f"""
             No minimum was found in the ELF line between at least one sites pair.
@@ -622,7 +859,7 @@ def get_site_neighbor_results_rough(
             will not work.
             
             The atoms for which this problem was found are located at:
-            {lattice["elements"][site_index]}: {lattice["coords"][site_index]}
+            {lattice.elements[site_index]}: {lattice.coords[site_index]}
             {neigh.species_string}: {neigh.frac_coords}
             """
         )
@@ -659,29 +896,70 @@ def get_site_neighbor_results_rough(
     ]
 
 
-def get_site_neighbor_results_fine(site_df, grid, lattice):
+def get_site_neighbor_results_fine(site_df, grid, lattice, fine_minima=None):
+    """
+    Refines the minimum along each ELF line in a site's dataframe with cubic
+    interpolation and updates the partitioning plane info. Returns an updated
+    copy of the dataframe.
+
+    fine_minima is an optional dictionary of refined minima that have already
+    been found for the representative pairs (see get_partitioning_fine and
+    get_fine_minimum_key). Pairs whose representative is in this dictionary
+    reuse its result instead of searching their line again. The result is
+    flipped for pairs whose line runs in the opposite direction
+    (pair_reversed). Pairs that don't need refinement (see
+    get_partitioning_rough) are left as they are.
+    """
+    site_df = site_df.copy()
+    updated_columns = {
+        column: list(site_df[column])
+        for column in [
+            "elf_min_index",
+            "elf_min_value",
+            "elf_min_frac",
+            "plane_point",
+            "distance",
+            "elf_min_vox",
+        ]
+    }
     # iterate through each neighbor in the dataframe and update the partitioning
     # plane info
-    for row in site_df.iterrows():
+    for i, row in enumerate(site_df.itertuples(index=False)):
+        # pairs whose rough minimum was already good enough are left as is
+        if not row.needs_refinement:
+            continue
         # get necessary information from the rough dataframe
-        elf_positions = row[1]["elf_positions"]
-        elf_min_index = row[1]["elf_min_index"]
-        site_pos = row[1]["site_pos"]
-        neigh_pos = row[1]["neigh_pos"]
+        site_pos = row.site_pos
+        neigh_pos = row.neigh_pos
         # get the minimum position along the elf line
+        fine_minimum_key = get_fine_minimum_key(row)
+        use_representative = fine_minima is not None and fine_minimum_key in fine_minima
+        if use_representative:
+            fine_minimum = fine_minima[fine_minimum_key]
+        else:
+            fine_minimum = get_line_frac_min_fine(
+                row.elf_positions, row.elf_min_index, grid
+            )
         #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         # This fails in mayenite in some cases so I'm letting it through for now.
         # This just uses the rough partitioning instead of the fine in instances
         # where it fails.
         #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        try:
+        if fine_minimum is None:
+            continue
+        elf_min_index_new, elf_min_value_new, elf_min_frac_new = fine_minimum
+        if use_representative and row.pair_reversed:
+            # the representative's line runs in the other direction
             (
                 elf_min_index_new,
                 elf_min_value_new,
                 elf_min_frac_new,
-            ) = get_line_frac_min_fine(elf_positions, elf_min_index, grid)
-        except:
-            continue
+            ) = get_reversed_line_min(
+                elf_min_index_new,
+                elf_min_value_new,
+                elf_min_frac_new,
+                len(row.elf_positions),
+            )
         # convert minimum in ELF line into voxel position
         elf_min_vox = get_position_from_min(elf_min_frac_new, site_pos, neigh_pos)
         # convert voxel position into real_space
@@ -689,19 +967,77 @@ def get_site_neighbor_results_fine(site_df, grid, lattice):
         # get the new distance between the site and the plane point
         distance = get_radius(plane_point, site_pos, lattice)
         # update the dataframe
-        row[1]["elf_min_index"] = elf_min_index_new
-        row[1]["elf_min_value"] = elf_min_value_new
-        row[1]["elf_min_frac"] = elf_min_frac_new
-        row[1]["plane_point"] = plane_point
-        row[1]["distance"] = distance
-        row[1]["elf_min_vox"] = elf_min_vox
+        updated_columns["elf_min_index"][i] = elf_min_index_new
+        updated_columns["elf_min_value"][i] = elf_min_value_new
+        updated_columns["elf_min_frac"][i] = elf_min_frac_new
+        updated_columns["plane_point"][i] = plane_point
+        updated_columns["distance"][i] = distance
+        updated_columns["elf_min_vox"][i] = elf_min_vox
+    # write the new values back into the dataframe. Setting values on the rows
+    # from iterrows only changes a copy of the row, so the refined minima
+    # were previously lost here.
+    for column, values in updated_columns.items():
+        site_df[column] = pd.Series(values, index=site_df.index, dtype=object)
+    for column in ["elf_min_index", "elf_min_value", "elf_min_frac", "distance"]:
+        site_df[column] = site_df[column].astype(np.float64)
     return site_df
 
 
-def get_partitioning_rough(neighbors26, lattice, grid, rough_partitioning=False):
+def get_fine_minimum_key(row):
+    """
+    Gets the key used to share refined minima between the pairs in a row of
+    the rough partitioning results: the representative pair and the rough
+    minimum index along the representative's line. A pair only reuses the
+    refined minimum of its representative if their rough minima match.
+    """
+    elf_min_index = int(row.elf_min_index)
+    if row.pair_reversed:
+        elf_min_index = len(row.elf_positions) - 1 - elf_min_index
+    return row.pair_representative, elf_min_index
+
+
+def get_partitioning_rough(
+    neighbors26,
+    lattice,
+    grid,
+    rough_partitioning=False,
+    use_symmetry=False,
+    symprec=0.01,
+    prune_planes=True,
+    refine_tolerance=None,
+    points_per_voxel=5,
+    element_radii=None,
+    radius_window=0.1,
+):
     # Get the closest 26 neighbors for each site
     # neighbors26 = get_26_neighbors(structure)
 
+    # The ELF line of each pair is sampled with about points_per_voxel points
+    # for each voxel of its length (see get_line_steps). If points_per_voxel
+    # is None, every line is sampled with 200 steps as in earlier versions.
+
+    # If element_radii is given, each line is first only sampled within
+    # radius_window (as a fraction of the line) of where the radii of the two
+    # elements put its minimum (see get_window_line_values). The rest of the
+    # line is only sampled if there is no minimum in this window, and is left
+    # as NaN in elf_values_rough otherwise.
+
+    # If refine_tolerance is given (in Angstrom), the rough minima are moved
+    # with a quadratic fit and a single step on the cubic interpolation (see
+    # get_lines_refined_min). Only the pairs where that step moves the plane
+    # further than refine_tolerance are searched again in
+    # get_partitioning_fine. Otherwise every pair is searched again.
+
+    # Each pair of neighboring sites appears twice, once in the list of each
+    # site. We only search the ELF line in one direction and flip the result
+    # for the other. If use_symmetry is True, site-neighbor pairs that are
+    # equivalent by the symmetry of the structure also share the same ELF
+    # line. We only search the line for one pair from each set and reuse its
+    # minimum for the others.
+
+    # The same interpolation of the grid is used for every site-neighbor pair
+    grid = get_grid_interpolator(grid)
+
     # Now we want to find the minimum in the ELF between the atom and each of its
     # neighbors and the vector between them. This will define a plane seperating
     # the atom from its neighbor.
@@ -722,101 +1058,195 @@ def get_partitioning_rough(neighbors26, lattice, grid, rough_partitioning=False)
         "elf_min_value",
         "elf_min_frac",
         "elf_min_vox",
+        "pair_index",
+        "pair_representative",
+        "pair_reversed",
+        "needs_refinement",
     ]
+    # gather every site-neighbor pair so that all of the lines can be sampled
+    # and searched for minima at once
+    pair_sites = []
+    pair_neighs = []
+    pair_neigh_sites = []
+    site_positions = []
+    neigh_positions = []
     for site_index, neighs in enumerate(neighbors26):
-        # create df for each site
-        site_df = pd.DataFrame(columns=columns)
         # get voxel position from fractional site
         site_pos = get_voxel_from_frac(site_index, lattice)
-        # site_pos_real = get_real_from_vox(site_pos, lattice)
-        # iterate through each neighbor to the site
-        for i, neigh in enumerate(neighs):
-            #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-            # Currently I have this passing errors because they showed up in
-            # mayenite.
-            #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-            try:
-                site_df.loc[len(site_df)] = get_site_neighbor_results_rough(
-                    site_index, neigh, lattice, site_pos, grid, rough_partitioning
-                )
-            except:
-                pass
-
-        #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        # # This is an old algorithm that didn't incorporate the correct planes
-        # # and caused errors in many structures. For now I am treating this
-        # # very rigorously and just using 26 partitioning planes now matter
-        # # that atom or system. I will update this in the future.
-        # # Finally, we want to figure out which of these planes are necessary to
-        # # completely partition our point from the surrounding atoms. To do this
-        # # we define a line segment between the point and the closest point on the
-        # # plane (the minimum of the ELF). Then we check if any other planes intersect
-        # # this line segment. If they don't then the plane belongs to the partitioning
-        # # set. If they do, then the plane is thrown out.
-        # #!!! SPEED UP: We should only have to do this for one neigh in each set
-        # # of distances. Others with the same distance would automatically be included
-        # # Remove duplicates from the df
-        # plane_distances = site_df["distance"].drop_duplicates().reset_index(drop=True)
-        # # # create a list to store the final set of neighbors
-        important_neighs = pd.DataFrame(columns=columns)
-        for [index, row] in site_df.iterrows():
-            #     # if the plane belongs to the set that is closest to the atom,
-            #     # automatically add this neighbor to the final set
-            #     if row["distance"] == plane_distances[0]:
-            #         important_neighs.loc[len(important_neighs)] = row
-            #     else:
-            #         # if the plane is not in this first set, check if any other planes
-            #         # intercept the line between it and the atom
-            #         point1 = row["plane_point"]
-            #         intercept = False
-            #         for [neigh_index, neigh_row] in site_df.iterrows():
-            #             if neigh_index != index:
-            #                 plane_point = neigh_row["plane_point"]
-            #                 plane_vector = neigh_row["plane_vector"]
-            #                 intersection = get_vector_plane_intersection(
-            #                     site_pos_real,
-            #                     point1,
-            #                     plane_point,
-            #                     plane_vector,
-            #                     allow_point_intercept=True,
-            #                 )
-            #                 # print(intersection)
-            #                 # if the line is not intersected, this plane is is part
-            #                 # of the partitioning set and we pass. Otherwise we
-            #                 # break and move on.
-            #                 if intersection is None:
-            #                     pass
-            #                 else:
-            #                     intercept = True
-            #                     break
-            #         if intercept == False:
-            #             important_neighs.loc[len(important_neighs)] = row
-            # #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-            # # This is a test algorithm to see if the same results are found
-            # # as when using an excessively large number of planes. It works
-            # # by checking if each plane point is underneath the other planes.
-            # # for a set of partitioning planes, all of these points should
-            # # be underneath any other potential partitioning plane
-            # under_planes = True
-            # # We need the plane point as a voxel because that's what the
-            # # sign function uses.
-            # min_point = row["elf_min_vox"]
-            # for [j, row1] in site_df.iterrows():
-            #     plane_point = row1["plane_point"]
-            #     plane_vector = row1["plane_vector"]
-            #     if j != index:
-            #         sign, distance = get_plane_sign(plane_point, plane_vector, min_point, lattice)
-            #         # print(sign)
-            #         if sign == "negative" or sign == "zero":
-            #             pass
-            #         else:
-            #             under_planes = False
-            #             break
-            # if under_planes == True:
-            #     important_neighs.loc[len(important_neighs)] = row
-            # #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-            important_neighs.loc[len(important_neighs)] = row
-        rough_partition_results.append(important_neighs)
+        for neigh in neighs:
+            pair_sites.append(site_index)
+            pair_neighs.append(neigh)
+            pair_neigh_sites.append(neigh.index)
+            site_positions.append(site_pos)
+            neigh_positions.append(get_voxel_from_neigh(neigh, lattice))
+    pair_sites = np.array(pair_sites, dtype=int)
+    site_positions = np.array(site_positions, dtype=np.float64).reshape(-1, 3)
+    neigh_positions = np.array(neigh_positions, dtype=np.float64).reshape(-1, 3)
+
+    # find the pairs that have the same ELF line
+    pair_representatives, pair_reversed = get_pair_representatives(
+        lattice=lattice,
+        pair_sites=pair_sites,
+        pair_neigh_sites=pair_neigh_sites,
+        pair_vectors=(neigh_positions - site_positions) / lattice.grid_size,
+        use_symmetry=use_symmetry,
+        symprec=symprec,
+    )
+    num_pairs = len(pair_sites)
+    real_site_positions = get_real_from_vox(site_positions, lattice)
+    bond_lengths = np.linalg.norm(
+        get_real_from_vox(neigh_positions, lattice) - real_site_positions, axis=1
+    )
+    # Each line is sampled with a number of steps that depends on how many
+    # voxels it crosses (see get_line_steps). Pairs that share a line use the
+    # steps of their representative so that their points line up.
+    if points_per_voxel is None:
+        pair_steps = np.full(num_pairs, 200)
+    else:
+        pair_steps = get_line_steps(
+            site_positions, neigh_positions, points_per_voxel=points_per_voxel
+        )[pair_representatives]
+
+    pair_radius_fracs = None
+    if element_radii is not None:
+        pair_radius_fracs = get_pair_radius_fracs(
+            lattice, pair_sites, pair_neigh_sites, element_radii
+        )
+
+    elf_positions = [None] * num_pairs
+    elf_values_rough = [None] * num_pairs
+    elf_min_index = np.zeros(num_pairs)
+    elf_min_value = np.zeros(num_pairs)
+    has_minimum = np.zeros(num_pairs, dtype=bool)
+    needs_refinement = np.full(num_pairs, not rough_partitioning)
+    # the lines with the same number of steps are sampled and searched together
+    for steps in np.unique(pair_steps):
+        group = np.flatnonzero(pair_steps == steps)
+        # we need a straight line between each pair. get all ELF values
+        group_positions = get_partitioning_line_positions(
+            site_positions[group], neigh_positions[group], grid.grid_size, steps
+        )
+        # the representative of each pair has the same steps, so it is also
+        # in the group
+        unique_pairs, unique_pair_lookup = np.unique(
+            pair_representatives[group], return_inverse=True
+        )
+        unique_rows = np.searchsorted(group, unique_pairs)
+        target_fracs = None
+        if pair_radius_fracs is None:
+            unique_values = grid.linear(group_positions[unique_rows])
+        else:
+            unique_values, windowed = get_window_line_values(
+                group_positions[unique_rows],
+                grid,
+                pair_radius_fracs[unique_pairs],
+                window=radius_window,
+            )
+            # the minimum of the lines that were only sampled in their window
+            # is the one closest to the expected position
+            target_fracs = np.where(
+                windowed[unique_pair_lookup], pair_radius_fracs[group], np.nan
+            )
+        # copy the values from each representative pair to the pairs that
+        # share its line. The lines of reversed pairs run from the other end.
+        group_values = unique_values[unique_pair_lookup]
+        group_reversed = pair_reversed[group]
+        group_values[group_reversed] = group_values[group_reversed, ::-1]
+        # find the minimum position and value along each elf_line. This is
+        # searched for every pair (it is cheap compared to the interpolation)
+        # so that lines with two minima equally close to the midpoint give
+        # the same result as before.
+        group_index, group_value, group_frac = get_lines_frac_min(
+            group_values, target_fracs=target_fracs
+        )
+
+        # For systems with considerable electron localization between atoms
+        # (ex. covalent systems) sometimes no minimum will be found except at
+        # the edges (see get_site_neighbor_results_rough). We skip these pairs.
+        #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+        # Currently I have this passing errors because they showed up in
+        # mayenite.
+        #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+        has_minimum[group] = get_lines_have_minimum(group_index, steps)
+
+        if rough_partitioning:
+            group_index, group_value, fitted = get_lines_quadratic_min(
+                group_values, group_index, group_value
+            )
+        elif refine_tolerance is not None:
+            group_index, group_value, group_refinement = get_lines_refined_min(
+                group_values,
+                site_positions[group],
+                neigh_positions[group],
+                group_index,
+                group_value,
+                grid,
+                point_length=bond_lengths[group] / steps,
+                refine_tolerance=refine_tolerance,
+            )
+            needs_refinement[group] = group_refinement
+        elf_min_index[group] = group_index
+        elf_min_value[group] = group_value
+        for line, pair in enumerate(group):
+            elf_positions[pair] = group_positions[line]
+            elf_values_rough[pair] = group_values[line]
+    # the fractional position is measured from site_pos
+    elf_min_frac = elf_min_index / pair_steps
+
+    # convert the minima in the ELF back into positions in the voxel grid
+    elf_min_vox = site_positions + elf_min_frac[:, np.newaxis] * (
+        neigh_positions - site_positions
+    )
+    # a point and normal vector describe a plane
+    # a(x-x1) + b(y-y1) + c(z-z1) = 0
+    # a,b,c is the normal vecotr, x1,y1,z1 is the point
+    # convert the voxel grid_pos back into the real_space
+    plane_points = get_real_from_vox(elf_min_vox, lattice)
+    # get the planes perpendicular to the bonds.
+    plane_vectors = get_real_from_vox(neigh_positions, lattice) - real_site_positions
+    plane_vectors /= np.linalg.norm(plane_vectors, axis=1)[:, np.newaxis]
+    # it is also helpful to know the distance of the minimum from the site
+    distances = np.linalg.norm(plane_points - real_site_positions, axis=1)
+    # The fine pass moves a minimum by at most 3 points along its line (see
+    # get_line_frac_min_fine). We keep any plane that could become a
+    # face if the planes around it moved by this much.
+    fine_margin = 2 * 3 * (bond_lengths / pair_steps).max()
+
+    for site_index in range(len(neighbors26)):
+        # create df for each site
+        pairs = np.flatnonzero((pair_sites == site_index) & has_minimum)
+        site_df = pd.DataFrame(
+            {
+                "site_index": site_index,
+                "site_pos": [site_positions[i] for i in pairs],
+                "neigh": [pair_neighs[i] for i in pairs],
+                "neigh_pos": [neigh_positions[i] for i in pairs],
+                "plane_point": [plane_points[i] for i in pairs],
+                "plane_vector": [plane_vectors[i] for i in pairs],
+                "distance": distances[pairs],
+                "elf_positions": [elf_positions[i] for i in pairs],
+                "elf_values_rough": [elf_values_rough[i] for i in pairs],
+                "elf_min_index": elf_min_index[pairs],
+                "elf_min_value": elf_min_value[pairs],
+                "elf_min_frac": elf_min_frac[pairs],
+                "elf_min_vox": [elf_min_vox[i] for i in pairs],
+                "pair_index": pairs,
+                "pair_representative": pair_representatives[pairs],
+                "pair_reversed": pair_reversed[pairs],
+                "needs_refinement": needs_refinement[pairs],
+            },
+            columns=columns,
+        )
+
+        # Only the planes that form the faces of the site's polyhedron are
+        # needed to partition it from its neighbors (see planes.py). If the
+        # planes are refined later, we keep the planes that are close enough
+        # to become faces after they move.
+        if prune_planes:
+            site_df = get_site_bounding_planes(
+                site_df, lattice, margin=0.0 if rough_partitioning else fine_margin
+            )
+        rough_partition_results.append(site_df)
 
     if rough_partitioning:
         results = {}
@@ -851,10 +1281,114 @@ def get_partitioning_rough(neighbors26, lattice, grid, rough_partitioning=False)
         return rough_partition_results
 
 
-def get_partitioning_fine(rough_partition_results, grid, lattice):
+def get_site_bounding_planes(site_df, lattice, margin=0.0):
+    """
+    Removes the planes in a site's dataframe that don't form a face of the
+    polyhedron around the site (see get_bounding_planes)
+    """
+    if len(site_df) == 0:
+        return site_df
+    keep = get_bounding_planes(
+        get_real_from_vox(site_df["site_pos"].iloc[0], lattice),
+        np.stack(site_df["plane_point"].to_numpy()),
+        np.stack(site_df["plane_vector"].to_numpy()),
+        margin=margin,
+    )
+    return site_df[keep].reset_index(drop=True)
+
+
+def get_site_fine_minima(lines, grid=None):
+    """
+    Refines the minima of a list of lines. Each line is a tuple of
+    (key, elf_positions, elf_min_index, pair_reversed) and the results are
+    returned in a dictionary by key in the direction of the representative
+    pair (see get_fine_minimum_key). If no grid is given, the interpolator of
+    the worker process is used (see load_worker_interpolator).
+    """
+    if grid is None:
+        grid = get_worker_interpolator()
+    fine_minima = {}
+    for key, elf_positions, elf_min_index, pair_reversed in lines:
+        fine_minimum = get_line_frac_min_fine(elf_positions, elf_min_index, grid)
+        if fine_minimum is not None and pair_reversed:
+            fine_minimum = get_reversed_line_min(*fine_minimum, len(elf_positions))
+        fine_minima[key] = fine_minimum
+    return fine_minima
+
+
+def get_fine_minima(rough_partition_results, grid, nprocs=1):
+    """
+    Refines the minimum of every line in the rough partitioning results that
+    needs refinement once (see get_partitioning_rough and
+    get_fine_minimum_key). Returns a
+    dictionary of the refined minima by key.
+
+    The lines of each site are refined together. If nprocs is more than 1 the
+    sites are spread over a process pool. The grid is shared with the workers
+    through memory mapped files (see write_shared_grid) rather than being
+    copied to each of them.
+    """
+    # gather the lines that still need refining for each site
+    site_lines = []
+    keys = set()
+    for site_df in rough_partition_results:
+        lines = []
+        for row in site_df.itertuples(index=False):
+            if not row.needs_refinement:
+                continue
+            key = get_fine_minimum_key(row)
+            if key in keys:
+                continue
+            keys.add(key)
+            lines.append((key, row.elf_positions, row.elf_min_index, row.pair_reversed))
+        site_lines.append(lines)
+
+    num_sites = len(site_lines)
+    fine_minima = {}
+    if nprocs <= 1:
+        for site_index, lines in enumerate(site_lines):
+            fine_minima.update(get_site_fine_minima(lines, grid))
+            print(f"Refined planes for site {site_index + 1}/{num_sites}")
+        return fine_minima
+
+    with TemporaryDirectory() as temp_directory:
+        write_shared_grid(grid, temp_directory)
+        with ProcessPoolExecutor(
+            max_workers=nprocs,
+            initializer=load_worker_interpolator,
+            initargs=(temp_directory,),
+        ) as executor:
+            futures = {
+                executor.submit(get_site_fine_minima, lines): site_index
+                for site_index, lines in enumerate(site_lines)
+                if len(lines) > 0
+            }
+            for sites_done, future in enumerate(as_completed(futures), start=1):
+                fine_minima.update(future.result())
+                print(
+                    f"Refined planes for site {futures[future] + 1}/{num_sites} "
+                    f"({sites_done}/{len(futures)} done)"
+                )
+    return fine_minima
+
+
+def get_partitioning_fine(
+    rough_partition_results, grid, lattice, prune_planes=True, nprocs=1
+):
+    # The same interpolation of the grid is used for every site-neighbor pair
+    grid = get_grid_interpolator(grid)
+    # Refine the minimum of each line once. Equivalent and reciprocal pairs
+    # then reuse these results.
+    fine_minima = get_fine_minima(rough_partition_results, grid, nprocs=nprocs)
     results = {}
     for site_index, site_df in enumerate(rough_partition_results):
-        fine_site_df = get_site_neighbor_results_fine(site_df, grid, lattice)
+        fine_site_df = get_site_neighbor_results_fine(
+            site_df, grid, lattice, fine_minima
+        )
+        # now that the planes have been refined, remove the ones that were
+        # only kept in case they moved
+        if prune_planes:
+            fine_site_df = get_site_bounding_planes(fine_site_df, lattice)
         neigh_dict = {}
         for neigh_row in fine_site_df.iterrows():
             # convert dataframe row into a dictionary
@@ -903,11 +1437,9 @@ def get_max_voxel_dist(lattice):
     """
     # We need to find the coordinates that make up a single voxel. This
     # is just the cartesian coordinates of the unit cell divided by
-    # its grid size
+    # its grid size, which we already have as the voxel matrix
     end = [0, 0, 0]
-    vox_a = [x / lattice["grid_size"][0] for x in lattice["a"]]
-    vox_b = [x / lattice["grid_size"][1] for x in lattice["b"]]
-    vox_c = [x / lattice["grid_size"][2] for x in lattice["c"]]
+    vox_a, vox_b, vox_c = lattice.voxel_matrix.tolist()
     # We want the three other vertices on the other side of the voxel. These
     # can be found by adding the vectors in a cycle (e.g. a+b, b+c, c+a)
     vox_a1 = [x + x1 for x, x1 in zip(vox_a, vox_b)]
@@ -933,10 +1465,39 @@ def get_max_voxel_dist(lattice):
     return max_distance
 
 
+def get_plane_voxel_dists(normal_vectors, lattice):
+    """
+    Finds the maximum distance a voxel's center can be from each plane and
+    still be intercepted by it. normal_vectors is an (planes, 3) array of the
+    unit normal vectors of the planes.
+
+    get_max_voxel_dist gives a single distance that works for every plane,
+    the distance from the center of a voxel to its furthest vertex. A plane
+    only reaches that far in the direction of that vertex. Measured along a
+    plane's normal n, the vertices of a voxel with edges a, b and c lie at
+    most (|n.a| + |n.b| + |n.c|) / 2 from its center, which can be much less
+    in skewed cells. Voxels further than this from a plane can't be cut by it.
+    """
+    normal_vectors = np.asarray(normal_vectors, dtype=np.float64).reshape(-1, 3)
+    return np.abs(normal_vectors @ lattice.voxel_matrix.T).sum(axis=1) / 2
+
+
 def get_matching_site(pos, results, lattice, max_distance):
     """
-    Determines which atomic site a point belongs to.
+    Determines which atomic site a point belongs to. results can be the
+    partitioning results or a PlaneTable made from them, which checks every
+    plane at once.
+
+    Points within max_distance of one of a site's planes are not matched to
+    it, as their voxel may be cut by the plane. For a PlaneTable,
+    max_distance can also be an array with a distance for each plane in the
+    table (see get_plane_voxel_dists).
     """
+    if isinstance(results, PlaneTable):
+        sites = results.get_matching_sites(
+            get_real_from_vox(pos, lattice), min_distance=max_distance
+        )
+        return get_single_site(sites)
     # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
     # I've had a bug in the past where more than one site is found for a single
     # voxel. As such, I'm going to temporarily make this function search all
@@ -994,8 +1555,44 @@ def get_matching_site(pos, results, lattice, max_distance):
     # return
 
 
+def get_single_site(sites):
+    """
+    Returns the site if exactly one site matched a position, None if no site
+    did and -1 if more than one did (see get_matching_site)
+    """
+    if len(sites) == 1:
+        return int(sites[0])
+    elif len(sites) == 0:
+        return
+    else:
+        return -1
+
+
+def get_result_sites(results):
+    """
+    Gets the sites in the partitioning results or a PlaneTable made from them
+    """
+    if isinstance(results, PlaneTable):
+        return range(results.num_sites)
+    return results.keys()
+
+
+def get_site_planes(results, site):
+    """
+    Gets the neighbor index, plane point and normal vector of each plane of a
+    site from the partitioning results or a PlaneTable made from them
+    """
+    if isinstance(results, PlaneTable):
+        planes = results.get_site_planes(site)
+        return zip(planes["neigh"].tolist(), planes["point"], planes["normal"])
+    return [
+        (values["neigh_index"], values["real_min_point"], values["normal_vector"])
+        for values in results[site].values()
+    ]
+
+
 def get_electride_sites(
-    lattice: dict,
+    lattice: Lattice,
 ):
     """
     Function for getting the number of sites that are electrides
@@ -1008,17 +1605,17 @@ def get_electride_sites(
     sites_of_electride = int()
     # When creating dummy atoms in electrides we usually use He because there
     # are so few materials that contain it.
-    if "He" in lattice["elements"]:
+    if "He" in lattice.elements:
         # iterates over element labels and finds the index for electride sites
-        for i, element in enumerate(lattice["elements"]):
+        for i, element in enumerate(lattice.elements):
             if element == "He":
                 # iterates over the number of each element. Since the electride
                 # is always added at the end, we can just add up the number of
                 # atoms before this point
                 for j in range(i):
-                    sites_before_electride += lattice["elements_num"][j]
+                    sites_before_electride += lattice.elements_num[j]
             # We find the total number of electride sites
-            sites_of_electride = lattice["elements_num"][i]
+            sites_of_electride = lattice.elements_num[i]
     for i in range(sites_of_electride):
         electride_sites.append(sites_before_electride + i)
     return electride_sites
@@ -1087,7 +1684,7 @@ def get_voxels_site_dask(
     df,
     results: dict,
     permutations: list,
-    lattice: dict,
+    lattice: Lattice,
     electride_sites: list,
     max_distance: float,
 ):
@@ -1160,6 +1757,9 @@ def get_voxels_site_dask(
 
 
 def get_matching_site_with_plane(vert_coord, results, lattice):
+    if isinstance(results, PlaneTable):
+        sites = results.get_matching_sites(get_real_from_vox(vert_coord, lattice))
+        return get_single_site(sites)
     # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
     # I've had a bug in the past where more than one site is found for a single
     # voxel location. As such, I'm going to temporarily make this function search all
@@ -1414,12 +2014,9 @@ def get_intersections_df(
     for site in sites["site"]:
         sites_to_search.remove(site)
         # iterate over each plane
-        for neighbor, values in results[site].items():
-            neighbor_index = values["neigh_index"]
+        for neighbor_index, plane_point, plane_vector in get_site_planes(results, site):
             # if neighbor is in the list of sites, look at the plane
             if neighbor_index in sites_to_search:
-                plane_point = values["real_min_point"]
-                plane_vector = values["normal_vector"]
                 # iterate over each edge and find the points that intersect
                 intersections = []
                 for edge in edges:
@@ -1444,7 +2041,7 @@ def get_intersections_df(
                 if len(intersections) > 0:
                     # if we have any intersections we add the site index, its
                     # neighbors index, and the list of intersections to the df
-                    plane_row = [site, values["neigh_index"], intersections]
+                    plane_row = [site, neighbor_index, intersections]
                     intersections_df.loc[len(intersections_df)] = plane_row
     return intersections_df
 
@@ -1479,7 +2076,7 @@ def get_site_volume_ratio(x, y, z, results, lattice, permutations, voxel_volume)
     # create dictionary for recording what fraction of a voxels volume should
     # be associated with a given site.
     site_vol_frac = {}
-    for site in results.keys():
+    for site in get_result_sites(results):
         site_vol_frac[site] = float(0)
 
     # shorten the lists to unique sites/planes
@@ -1704,7 +2301,7 @@ def get_site_volume_ratio(x, y, z, results, lattice, permutations, voxel_volume)
 def get_voxels_site_volume_ratio_dask(
     df,
     results: dict,
-    lattice: dict,
+    lattice: Lattice,
     permutations: list,
     voxel_volume: float,
 ):
@@ -1731,7 +2328,7 @@ def get_voxels_site_multi_plane(
     z,
     pdf,
     near_plane_pdf,
-    lattice: dict,
+    lattice: Lattice,
     electride_sites: list,
     results: dict,
 ):
@@ -1744,7 +2341,7 @@ def get_voxels_site_multi_plane(
     # of sites
     site_count = {}
     site_frac = {}
-    for site in results.keys():
+    for site in get_result_sites(results):
         site_count[site] = int(0)
 
     # look at all neighbors and tally which site they belong to.
@@ -1752,15 +2349,15 @@ def get_voxels_site_multi_plane(
         new_idx = [x - 1 + t, y - 1 + u, z - 1 + v]
 
         # wrap around for voxels on edge of cell
-        new_idx = [a % b for a, b in zip(new_idx, lattice["grid_size"])]
+        new_idx = [a % b for a, b in zip(new_idx, lattice.grid_size)]
 
         # get site from the sites that have already been found using the sites
         # index. This is much faster than searching by values. To get the index
         # we can utilize the fact that an increase in z will increase the index
         # by 1, an increase in y will increase the index by (range of z),
         # and an increase in x will increase the index by (range of z)*(range of y)
-        zrange = lattice["grid_size"][2]
-        yrange = lattice["grid_size"][1]
+        zrange = lattice.grid_size[2]
+        yrange = lattice.grid_size[1]
         index = int((new_idx[0]) * zrange * yrange + (new_idx[1]) * zrange + new_idx[2])
         site = pdf["site"].iloc[index]
         # If site exists and isn't an electride site, add to the count. This
@@ -1800,7 +2397,7 @@ def get_voxels_site_nearest(
     y,
     z,
     permutations: list,
-    lattice: dict,
+    lattice: Lattice,
 ):
     """
     This function finds the closest atom to a voxel.
@@ -1810,7 +2407,7 @@ def get_voxels_site_nearest(
     distances = []
 
     # get lists of atom coordinates and site numbers
-    atom_coords = lattice["coords"]
+    atom_coords = lattice.coords
     atom_site_indices = [i for i in range(len(atom_coords))]
 
     for t, u, v in permutations:
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import struct
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+###############################################################################
+# This module defines a binary cache for the volumetric grids (ELFCAR, CHGCAR)
+# used by BadELF. Parsing these text files is often the slowest part of a run
+# for small cells, and the same file is usually read several times (radius
+# search, partitioning, charge integration). The first time a grid is loaded
+# it is written to a sidecar file next to the original. Later loads return a
+# read-only memory map of that sidecar instead of re-parsing the text.
+###############################################################################
+
+# The sidecar starts with a magic string and the length of a json header. The
+# raw grid follows, starting at a multiple of the page size so that it can be
+# memory mapped directly.
+CACHE_MAGIC = b"BADELFGC"
+CACHE_VERSION = 1
+CACHE_SUFFIX = ".gridcache"
+CACHE_ALIGNMENT = 4096
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def get_cache_filename(filename: Path):
+    """
+    Gets the name of the sidecar cache file for a volumetric file
+    (e.g. ELFCAR -> ELFCAR.gridcache)
+    """
+    filename = Path(filename)
+    return filename.with_name(filename.name + CACHE_SUFFIX)
+
+
+def get_file_hash(filename: Path):
+    """
+    Gets a blake2b hash of a file's contents. The file is read in large blocks
+    so that this stays cheap compared to parsing it.
+    """
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_data_offset(header_length: int):
+    """
+    Gets the offset of the grid data in a cache file with a json header of the
+    given length
+    """
+    start = len(CACHE_MAGIC) + 8 + header_length
+    return -(-start // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
+
+
+def read_cache_header(cache_file: Path):
+    """
+    Reads the json header from a cache file. Returns None if the file is not
+    a grid cache of the current version.
+    """
+    try:
+        with open(cache_file, "rb") as file:
+            if file.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                return None
+            (header_length,) = struct.unpack("<Q", file.read(8))
+            header = json.loads(file.read(header_length).decode())
+    except (OSError, ValueError, struct.error):
+        return None
+    if header.get("version") != CACHE_VERSION:
+        return None
+    header["offset"] = get_data_offset(header_length)
+    return header
+
+
+def encode_cache_header(header: dict):
+    """
+    Converts a cache header to the json bytes stored in the file. The data
+    offset is not stored because it follows from the header length.
+    """
+    header = {key: value for key, value in header.items() if key != "offset"}
+    return json.dumps(header).encode()
+
+
+def write_cache_header(file, header: dict):
+    """
+    Writes the magic string and json header to an open cache file and pads it
+    so that the grid data starts on an aligned offset. Returns that offset.
+    """
+    header_bytes = encode_cache_header(header)
+    offset = get_data_offset(len(header_bytes))
+    file.seek(0)
+    file.write(CACHE_MAGIC)
+    file.write(struct.pack("<Q", len(header_bytes)))
+    file.write(header_bytes)
+    file.write(b"\0" * (offset - len(CACHE_MAGIC) - 8 - len(header_bytes)))
+    return offset
+
+
+def check_cache_is_valid(filename: Path, cache_file: Path, header: dict, kind: str):
+    """
+    Checks that a cache file still matches the volumetric file it was made from.
+    The file size must match. If the modification time has changed (e.g. the
+    file was copied) we fall back to comparing a hash of the contents, and
+    refresh the stored modification time if the contents are unchanged.
+    """
+    if header.get("kind") != kind:
+        return False
+    stat = os.stat(filename)
+    if stat.st_size != header["source_size"]:
+        return False
+    if stat.st_mtime_ns == header["source_mtime_ns"]:
+        return True
+    if get_file_hash(filename) != header["source_hash"]:
+        return False
+    # The contents are the same, so we update the header to avoid hashing
+    # the file again next time. This can be done in place as long as the
+    # data offset doesn't move.
+    updated_header = dict(header, source_mtime_ns=stat.st_mtime_ns)
+    new_length = len(encode_cache_header(updated_header))
+    if get_data_offset(new_length) == header["offset"]:
+        try:
+            with open(cache_file, "r+b") as file:
+                write_cache_header(file, updated_header)
+        except OSError:
+            pass
+    return True
+
+
+def write_grid_cache(filename: Path, cache_file: Path, grid: np.ndarray, kind: str):
+    """
+    Writes a grid to a sidecar cache file. The file is written under a temporary
+    name and then moved into place so that other processes never see a partly
+    written cache.
+    """
+    stat = os.stat(filename)
+    header = {
+        "version": CACHE_VERSION,
+        "kind": kind,
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "source_hash": get_file_hash(filename),
+        "shape": list(grid.shape),
+        "dtype": np.dtype(np.float64).str,
+    }
+    temp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    try:
+        with open(temp_file, "wb") as file:
+            write_cache_header(file, header)
+            # The grids are stored in Fortran order to match the VASP layout
+            np.asfortranarray(grid, dtype=np.float64).ravel(order="F").tofile(file)
+        os.replace(temp_file, cache_file)
+    finally:
+        if temp_file.exists():
+            temp_file.unlink()
+
+
+def get_cached_grid(
+    filename: Path,
+    loader,
+    kind: str,
+    grid_size: list,
+    **loader_kwargs,
+):
+    """
+    Loads a volumetric grid through its binary cache. If a valid cache exists a
+    read-only memory map of it is returned. Otherwise the grid is parsed with
+    the loader function (called as loader(filename, **loader_kwargs)), written
+    to the cache, and returned.
+
+    The kind is a label for what part of the file the loader reads (e.g.
+    "partitioning" or "charge") so that different loaders don't share a cache.
+    """
+    filename = Path(filename)
+    cache_file = get_cache_filename(filename)
+    grid_size = [int(x) for x in grid_size]
+
+    header = read_cache_header(cache_file)
+    if (
+        header is not None
+        and header["shape"] == grid_size
+        and check_cache_is_valid(filename, cache_file, header, kind)
+    ):
+        return np.memmap(
+            cache_file,
+            dtype=np.dtype(header["dtype"]),
+            mode="r",
+            offset=header["offset"],
+            shape=tuple(grid_size),
+            order="F",
+        )
+
+    grid = loader(filename, **loader_kwargs)
+    # Failing to write the cache (e.g. read-only directory, full disk) should
+    # never stop the algorithm, so we only warn here.
+    try:
+        write_grid_cache(filename, cache_file, grid, kind)
+    except OSError as error:
+        warnings.warn(f"Could not write grid cache for {filename}: {error}")
+    return grid
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+
+import numpy as np
+from scipy.ndimage import map_coordinates, spline_filter
+
+###############################################################################
+# This module defines the interpolation of the partitioning grid (usually the
+# ELF) used when searching for the minima between atoms. The grid is periodic,
+# so values between voxels near the cell edges are interpolated with voxels
+# from the other side of the cell.
+#
+# Positions are always given in VASP voxel coordinates, where the first voxel
+# is at 1 (see get_voxel_from_frac). They don't need to be wrapped into the
+# cell beforehand.
+#
+# For work spread over a process pool, the grid and its spline coefficients are
+# written once to .npy files that every worker opens as read-only memory maps.
+# The workers then share the same pages of memory instead of each getting a
+# pickled copy of the grid.
+###############################################################################
+
+# The interpolator used by functions running in a worker process (see
+# load_worker_interpolator)
+worker_interpolator = None
+
+
+class PeriodicGridInterpolator:
+    """
+    Interpolates a periodic grid at arbitrary voxel positions. This is built
+    once for each grid and reused for every site-neighbor pair so that the grid
+    is never copied more than once.
+
+    Linear interpolation wraps around the cell edges directly with
+    scipy.ndimage.map_coordinates and doesn't need any setup. Cubic
+    interpolation uses a periodic cubic B-spline through the grid points. The
+    B-spline coefficients are found once for the whole grid (with
+    scipy.ndimage.spline_filter) the first time they are needed, so that each
+    evaluation after that only sums the 64 coefficients around each point.
+    spline_coefficients can be given if they were already found for this grid
+    (see load_worker_interpolator).
+    """
+
+    def __init__(self, grid, spline_coefficients=None):
+        self.grid = np.asarray(grid, dtype=np.float64)
+        self.grid_size = np.array(self.grid.shape)
+        self.spline_coefficients = spline_coefficients
+
+    def linear(self, positions):
+        """
+        Gets the linearly interpolated value of the grid at each voxel position.
+        positions is an array with shape (..., 3) and the returned array has
+        the shape (...).
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        # shift from VASP voxel indices (starting at 1) to array indices
+        coords = (positions.reshape(-1, 3) - 1).T
+        values = map_coordinates(self.grid, coords, order=1, mode="grid-wrap")
+        return values.reshape(positions.shape[:-1])
+
+    def get_spline_coefficients(self):
+        """
+        Finds the periodic cubic B-spline coefficients of the grid if they
+        haven't been found yet
+        """
+        if self.spline_coefficients is None:
+            self.spline_coefficients = spline_filter(
+                self.grid, order=3, output=np.float64, mode="grid-wrap"
+            )
+        return self.spline_coefficients
+
+    def cubic(self, positions):
+        """
+        Gets the cubic interpolated value of the grid at each voxel position.
+        positions is an array with shape (..., 3) and the returned array has
+        the shape (...).
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        coords = (positions.reshape(-1, 3) - 1).T
+        values = map_coordinates(
+            self.get_spline_coefficients(),
+            coords,
+            order=3,
+            mode="grid-wrap",
+            prefilter=False,
+        )
+        return values.reshape(positions.shape[:-1])
+
+
+def get_grid_interpolator(grid):
+    """
+    Returns a PeriodicGridInterpolator for a grid. If the grid is already an
+    interpolator it is returned as is, so functions can be given either one.
+    """
+    if isinstance(grid, PeriodicGridInterpolator):
+        return grid
+    return PeriodicGridInterpolator(grid)
+
+
+def write_shared_grid(grid, directory: Path):
+    """
+    Writes a grid (or the grid of a PeriodicGridInterpolator) and its spline
+    coefficients to .npy files in the given directory so that worker
+    processes can open them as memory maps. Returns the directory.
+    """
+    interpolator = get_grid_interpolator(grid)
+    directory = Path(directory)
+    np.save(directory / "shared_grid.npy", interpolator.grid)
+    np.save(
+        directory / "shared_spline_coefficients.npy",
+        interpolator.get_spline_coefficients(),
+    )
+    return directory
+
+
+def load_worker_interpolator(directory: Path):
+    """
+    Sets up the interpolator for a worker process from the files written by
+    write_shared_grid. This is meant to be the initializer of a process pool.
+    """
+    global worker_interpolator
+    directory = Path(directory)
+    worker_interpolator = PeriodicGridInterpolator(
+        np.load(directory / "shared_grid.npy", mmap_mode="r"),
+        spline_coefficients=np.load(
+            directory / "shared_spline_coefficients.npy", mmap_mode="r"
+        ),
+    )
+
+
+def get_worker_interpolator():
+    """
+    Gets the interpolator set up by load_worker_interpolator in this process
+    """
+    return worker_interpolator
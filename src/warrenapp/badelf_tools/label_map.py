@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+from math import prod as product
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+###############################################################################
+# This module defines the voxel label map that can be saved at the end of a
+# BadELF run. It records which site every voxel was assigned to, so that other
+# densities can be integrated over the same partition (or the partition can be
+# visualized) without running the algorithm again.
+#
+# The map has two parts:
+#   labels: an integer grid with the same shape as the ELFCAR/CHGCAR grid. Each
+#       voxel holds the index of its site. Voxels that are split between sites
+#       hold the site with the largest share. Voxels that were never assigned
+#       hold the largest value of the dtype (see get_unassigned_label).
+#   split voxels: a sparse table of (voxel index, site, fraction) for every voxel
+#       that is shared by more than one site. The voxel index is the flat index
+#       into the grid in C order.
+###############################################################################
+
+LABEL_MAP_FILENAME = "badelf_labels.npz"
+
+
+def get_label_dtype(num_sites: int):
+    """
+    Gets the smallest unsigned integer type that can hold every site index
+    plus the unassigned label
+    """
+    if num_sites < np.iinfo(np.uint16).max:
+        return np.dtype(np.uint16)
+    return np.dtype(np.uint32)
+
+
+def get_unassigned_label(labels: np.ndarray):
+    """
+    Gets the label used for voxels that were not assigned to any site
+    """
+    return np.iinfo(labels.dtype).max
+
+
+def get_voxel_label_map(
+    grid_size: list,
+    num_sites: int,
+    site_labels: pd.Series,
+    voxel_site_fractions: list = None,
+):
+    """
+    Builds the label grid and split voxel table from the results of a BadELF
+    run.
+
+    site_labels is a Series indexed by flat voxel index (C order) holding the
+    site found for each voxel in the first pass, or None/NaN if none was found.
+    voxel_site_fractions is a list of Series from the later passes, also
+    indexed by flat voxel index. Their values are either a single site or a
+    dictionary of {site: fraction}. They are applied in order, so a later pass
+    overrides an earlier one for the same voxel. Negative sites are the error
+    flags used by get_site_volume_ratio and are ignored.
+    """
+    num_voxels = product(int(x) for x in grid_size)
+    labels = np.full(num_voxels, np.nan)
+    labels[site_labels.index.to_numpy()] = pd.to_numeric(
+        site_labels, errors="coerce"
+    ).to_numpy(dtype=np.float64)
+
+    # The split voxels are only the ones near partitioning planes, so we can
+    # handle them one at a time.
+    split_voxels = {}
+    for site_fractions in voxel_site_fractions or []:
+        for voxel_index, sites in site_fractions.items():
+            if isinstance(sites, dict):
+                sites = {
+                    site: fraction
+                    for site, fraction in sites.items()
+                    if site >= 0 and fraction > 0
+                }
+                if len(sites) == 0:
+                    continue
+                labels[voxel_index] = max(sites, key=sites.get)
+                if len(sites) > 1:
+                    split_voxels[voxel_index] = sites
+                else:
+                    split_voxels.pop(voxel_index, None)
+            elif sites is not None and not pd.isna(sites):
+                labels[voxel_index] = sites
+                split_voxels.pop(voxel_index, None)
+
+    dtype = get_label_dtype(num_sites)
+    unassigned = np.isnan(labels)
+    labels[unassigned] = np.iinfo(dtype).max
+    labels = labels.astype(dtype).reshape([int(x) for x in grid_size])
+
+    split_voxel_index = []
+    split_site = []
+    split_fraction = []
+    for voxel_index, sites in split_voxels.items():
+        for site, fraction in sites.items():
+            split_voxel_index.append(voxel_index)
+            split_site.append(site)
+            split_fraction.append(fraction)
+
+    return {
+        "labels": labels,
+        "split_voxel_index": np.array(split_voxel_index, dtype=np.int64),
+        "split_site": np.array(split_site, dtype=dtype),
+        "split_fraction": np.array(split_fraction, dtype=np.float64),
+    }
+
+
+def write_label_map(filename: Path, label_map: dict, structure=None):
+    """
+    Writes a label map to a compressed npz file. If a structure is given, it
+    is stored as POSCAR text so the file can be used on its own.
+    """
+    extra_data = {}
+    if structure is not None:
+        # imported here to keep this module light for readers of the file
+        from pymatgen.io.vasp.inputs import Poscar
+
+        extra_data["poscar"] = np.array(str(Poscar(structure)))
+    np.savez_compressed(filename, **label_map, **extra_data)
+
+
+def read_label_map(filename: Path):
+    """
+    Reads a label map written by write_label_map into a dictionary of arrays
+    """
+    with np.load(filename) as data:
+        label_map = {key: data[key] for key in data.files}
+    if "poscar" in label_map:
+        label_map["poscar"] = str(label_map["poscar"])
+    return label_map
+
+
+def get_site_sums(label_map: dict, grid: np.ndarray, num_sites: int = None):
+    """
+    Sums a grid (e.g. a CHGCAR with the same grid size) over each site of a
+    label map. Split voxels are shared between their sites using the stored
+    fractions. Returns an array with one value for each site.
+    """
+    labels = label_map["labels"].ravel()
+    values = np.asarray(grid).ravel()
+    if num_sites is None:
+        num_sites = int(labels[labels != get_unassigned_label(labels)].max()) + 1
+    # count whole voxels first, leaving out split and unassigned voxels
+    whole_voxels = labels != get_unassigned_label(labels)
+    whole_voxels[label_map["split_voxel_index"]] = False
+    site_sums = np.bincount(
+        labels[whole_voxels], weights=values[whole_voxels], minlength=num_sites
+    )
+    site_sums += np.bincount(
+        label_map["split_site"],
+        weights=label_map["split_fraction"] * values[label_map["split_voxel_index"]],
+        minlength=num_sites,
+    )
+    return site_sums
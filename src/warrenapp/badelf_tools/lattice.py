@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+class Lattice:
+    """
+    Stores the lattice, atom positions, and grid information read from the
+    header of a VASP volumetric file (see get_lattice). Everything the
+    BadELF algorithm needs for coordinate conversions is precomputed as numpy
+    arrays so that the functions that run for every voxel don't have to
+    rebuild them.
+
+    The lattice vectors are the rows of `matrix`, and the rows of
+    `voxel_matrix` are the vectors along the edges of a single voxel. A voxel
+    position (VASP indexing starting at 1) is converted to cartesian
+    coordinates with `(voxel_position - 1) @ voxel_matrix`.
+    """
+
+    __slots__ = (
+        "matrix",
+        "inverse_matrix",
+        "voxel_matrix",
+        "inverse_voxel_matrix",
+        "grid_size",
+        "coords",
+        "elements",
+        "elements_num",
+        "num_atoms",
+        "volume",
+        "voxel_volume",
+    )
+
+    def __init__(
+        self,
+        matrix,
+        coords,
+        grid_size,
+        elements: list,
+        elements_num: list,
+    ):
+        self.matrix = np.array(matrix, dtype=np.float64).reshape(3, 3)
+        self.inverse_matrix = np.linalg.inv(self.matrix)
+        self.grid_size = np.array(grid_size, dtype=np.int64)
+        self.voxel_matrix = self.matrix / self.grid_size[:, np.newaxis]
+        self.inverse_voxel_matrix = np.linalg.inv(self.voxel_matrix)
+        self.coords = np.array(coords, dtype=np.float64).reshape(-1, 3)
+        self.elements = list(elements)
+        self.elements_num = [int(x) for x in elements_num]
+        self.num_atoms = sum(self.elements_num)
+        self.volume = np.dot(np.cross(self.matrix[0], self.matrix[1]), self.matrix[2])
+        self.voxel_volume = self.volume / np.prod(self.grid_size)
+
+    @property
+    def a(self):
+        return self.matrix[0]
+
+    @property
+    def b(self):
+        return self.matrix[1]
+
+    @property
+    def c(self):
+        return self.matrix[2]
+
+    def __getitem__(self, key: str):
+        # The lattice used to be a dictionary. This allows older scripts that
+        # use lattice["grid_size"] etc. to keep working.
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return (
+            f"Lattice(elements={self.elements}, elements_num={self.elements_num}, "
+            f"grid_size={self.grid_size.tolist()})"
+        )
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import warnings
+from pathlib import Path
+
+import numpy as np
+from simmate.toolkit import Structure
+
+from warrenapp.badelf_tools.plane_table import PLANE_TABLE_DTYPE, PlaneTable
+
+###############################################################################
+# This module defines an on-disk cache for the partitioning planes. Finding the
+# planes only depends on the partitioning grid, the structure and a few
+# settings, but BadELF is often re-run on the same directory after changing
+# something later in the workflow (e.g. print_atom_voxels or the charge file).
+# The first run writes its plane table (see plane_table.py) to a sidecar file
+# next to the partitioning file along with a hash of everything the planes
+# depend on. Later runs with the same hash load the planes from this file and
+# skip the partitioning entirely.
+###############################################################################
+
+# The key only covers the inputs and settings of the plane finding, not the
+# code. This version must be bumped whenever a change to the partitioning
+# moves the planes, so that older cache files are not reused.
+PLANE_CACHE_VERSION = 2
+PLANE_CACHE_SUFFIX = ".planecache.npz"
+
+
+def get_plane_cache_filename(filename: Path):
+    """
+    Gets the name of the sidecar plane cache file for a partitioning file
+    (e.g. ELFCAR -> ELFCAR.planecache.npz)
+    """
+    filename = Path(filename)
+    return filename.with_name(filename.name + PLANE_CACHE_SUFFIX)
+
+
+def get_plane_cache_key(grid: np.ndarray, structure: Structure, **settings):
+    """
+    Gets a blake2b hash of the partitioning grid's values, the structure and
+    all settings that change the planes (e.g. use_symmetry or
+    points_per_voxel). Two runs with the same key find the same planes.
+    """
+    cache_hash = hashlib.blake2b(digest_size=16)
+    description = {
+        "version": PLANE_CACHE_VERSION,
+        "shape": [int(x) for x in np.shape(grid)],
+        "lattice": structure.lattice.matrix.tolist(),
+        "species": [str(species) for species in structure.species],
+        "frac_coords": structure.frac_coords.tolist(),
+        "settings": settings,
+    }
+    cache_hash.update(json.dumps(description, sort_keys=True).encode())
+    # The grids are stored in Fortran order (see grid_cache.py), so this
+    # doesn't copy them.
+    cache_hash.update(np.asfortranarray(grid, dtype=np.float64).ravel(order="F"))
+    return cache_hash.hexdigest()
+
+
+def read_plane_cache(cache_file: Path, key: str):
+    """
+    Reads the plane table from a cache file. Returns None if there is no
+    cache file or if it was made with a different key.
+    """
+    try:
+        with np.load(cache_file, allow_pickle=False) as cache:
+            if str(cache["key"]) != key or cache["planes"].dtype != PLANE_TABLE_DTYPE:
+                return None
+            return PlaneTable(cache["planes"], cache["site_offsets"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_plane_cache(cache_file: Path, key: str, plane_table: PlaneTable):
+    """
+    Writes a plane table to a cache file. As with the grid cache, the file is
+    written under a temporary name and then moved into place. Failing to
+    write the cache only gives a warning.
+    """
+    cache_file = Path(cache_file)
+    temp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp.npz")
+    try:
+        np.savez(
+            temp_file,
+            key=np.array(key),
+            planes=plane_table.planes,
+            site_offsets=plane_table.site_offsets,
+        )
+        os.replace(temp_file, cache_file)
+    except OSError as error:
+        warnings.warn(f"Could not write plane cache {cache_file}: {error}")
+    finally:
+        if temp_file.exists():
+            temp_file.unlink()
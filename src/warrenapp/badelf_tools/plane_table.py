@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+###############################################################################
+# This module defines a compact table of the partitioning planes. The results
+# of get_partitioning_rough/get_partitioning_fine are a dictionary of sites,
+# each holding a dictionary of neighbors, each holding a dictionary of numpy
+# vectors, pymatgen neighbor objects and the whole ELF line. That is
+# convenient to look through, but it is large and slow to send to every dask
+# worker, and checking a voxel against it means looping over all of it in
+# python.
+#
+# The plane table holds the same planes as one structured numpy array with a
+# row for each plane. The planes are grouped by site, and the planes of site i
+# are the rows site_offsets[i] to site_offsets[i+1] (the same layout as a
+# compressed sparse row matrix).
+###############################################################################
+
+PLANE_TABLE_DTYPE = np.dtype(
+    [
+        ("site", np.int32),
+        ("neigh", np.int32),
+        ("image", np.int32, 3),
+        ("point", np.float64, 3),
+        ("normal", np.float64, 3),
+        ("radius", np.float64),
+        ("elf_value", np.float64),
+        ("elf_frac", np.float64),
+    ]
+)
+
+
+class PlaneTable:
+    """
+    A table of the partitioning planes of every site (see the top of this
+    module). planes is a structured array with the PLANE_TABLE_DTYPE and
+    site_offsets an array with the first row of each site's planes followed by
+    the total number of planes.
+    """
+
+    def __init__(self, planes: np.ndarray, site_offsets: np.ndarray):
+        self.planes = planes
+        self.site_offsets = np.asarray(site_offsets, dtype=np.int64)
+        self.num_sites = len(self.site_offsets) - 1
+
+    @classmethod
+    def from_results(cls, results: dict):
+        """
+        Builds the plane table from the results of get_partitioning_rough or
+        get_partitioning_fine. The sites must be numbered 0 to (sites - 1).
+        """
+        num_sites = len(results)
+        num_planes = [len(results.get(site, {})) for site in range(num_sites)]
+        site_offsets = np.concatenate([[0], np.cumsum(num_planes)])
+        planes = np.zeros(site_offsets[-1], dtype=PLANE_TABLE_DTYPE)
+        row = 0
+        for site in range(num_sites):
+            for values in results.get(site, {}).values():
+                planes[row] = (
+                    site,
+                    values["neigh_index"],
+                    np.round(values["neigh"].image),
+                    values["real_min_point"],
+                    values["normal_vector"],
+                    values["radius"],
+                    values["value_elf"],
+                    values["pos_elf_frac"],
+                )
+                row += 1
+        return cls(planes, site_offsets)
+
+    def get_site_planes(self, site: int):
+        """
+        Gets the rows of the table for one site
+        """
+        return self.planes[self.site_offsets[site] : self.site_offsets[site + 1]]
+
+    def get_plane_values(self, real_pos):
+        """
+        Gets the value of every plane's equation at a cartesian position, i.e.
+        normal . (real_pos - point). This is negative on the same side of the
+        plane as the plane's site.
+        """
+        return np.einsum(
+            "ij,ij->i", self.planes["normal"], real_pos - self.planes["point"]
+        )
+
+    def get_matching_sites(self, real_pos, min_distance: float = 0.0):
+        """
+        Gets the sites whose planes all have the position on their negative
+        side by more than min_distance (and by more than 1e-6 to allow for
+        rounding, as in get_plane_sign). min_distance can be a single distance
+        or an array with a distance for each plane.
+        """
+        plane_values = self.get_plane_values(real_pos)
+        outside = (plane_values >= -1e-6) | (-plane_values <= min_distance)
+        planes_outside = np.bincount(
+            self.planes["site"][outside], minlength=self.num_sites
+        )
+        return np.flatnonzero(planes_outside == 0)
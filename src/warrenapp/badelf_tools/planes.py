@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from scipy.spatial import ConvexHull, HalfspaceIntersection, QhullError
+
+###############################################################################
+# This module defines functions for working with the set of partitioning
+# planes around each site. A site and its planes define a convex polyhedron,
+# and a point belongs to the site if it is on the negative side of every plane.
+#
+# Each site starts out with a plane for each of its 50 nearest neighbors, but
+# most of these planes lie completely outside of the polyhedron formed by the
+# others and never decide which site a point belongs to. Only the planes that
+# form the faces of the polyhedron (usually 12-20) need to be kept.
+#
+# A plane is described by a point on the plane and a unit normal vector
+# pointing away from the site, so that
+#     normal_vector . (x - plane_point) < 0
+# for every point x on the same side as the site.
+###############################################################################
+
+
+def get_polyhedron_vertices(site_point, plane_points, plane_vectors):
+    """
+    Finds the vertices of the convex polyhedron formed by a set of planes
+    around a site. All positions are cartesian. Returns an array of vertices
+    or None if the planes don't enclose the site (e.g. the polyhedron is open
+    on one side).
+    """
+    site_point = np.asarray(site_point, dtype=np.float64)
+    plane_vectors = np.asarray(plane_vectors, dtype=np.float64).reshape(-1, 3)
+    # Work relative to the site so that the site is the origin. Qhull expects
+    # each halfspace as [A, b] with A . x + b <= 0
+    plane_points = np.asarray(plane_points, dtype=np.float64).reshape(-1, 3)
+    offsets = -np.einsum("ij,ij->i", plane_vectors, plane_points - site_point)
+    if np.any(offsets >= 0):
+        # the site isn't inside of every plane
+        return None
+    halfspaces = np.column_stack([plane_vectors, offsets])
+    try:
+        # The polyhedron is only closed if the normal vectors point in every
+        # direction, i.e. the origin is inside of their convex hull.
+        normal_hull = ConvexHull(plane_vectors)
+        if np.any(normal_hull.equations[:, -1] >= -1e-8):
+            return None
+        intersection = HalfspaceIntersection(halfspaces, np.zeros(3))
+    except (QhullError, ValueError):
+        return None
+    vertices = intersection.intersections
+    if not np.all(np.isfinite(vertices)):
+        return None
+    return vertices + site_point
+
+
+def get_plane_distances(vertices, plane_points, plane_vectors):
+    """
+    Gets the signed distance of each vertex from each plane as an array with
+    shape (planes, vertices). Vertices inside the polyhedron have negative
+    distances.
+    """
+    plane_points = np.asarray(plane_points, dtype=np.float64).reshape(-1, 3)
+    plane_vectors = np.asarray(plane_vectors, dtype=np.float64).reshape(-1, 3)
+    plane_offsets = np.einsum("ij,ij->i", plane_vectors, plane_points)
+    return plane_vectors @ vertices.T - plane_offsets[:, np.newaxis]
+
+
+def get_bounding_planes(
+    site_point,
+    plane_points,
+    plane_vectors,
+    margin: float = 0.0,
+    tol: float = 1e-6,
+):
+    """
+    Finds the planes that form the faces of the polyhedron around a site.
+    Returns a boolean array that is True for each plane that should be kept.
+
+    A plane is kept if any vertex of the polyhedron is within tol of it (or on
+    its positive side). If margin is given, planes that come within margin
+    of the polyhedron are also kept. This is used when the planes are still
+    going to be moved a little (see get_partitioning_rough).
+
+    The pruned set is checked against the full set: the polyhedron built from
+    only the kept planes must not poke through any of the removed planes. If
+    this fails, or the polyhedron can't be built, every plane is kept.
+    """
+    num_planes = len(plane_vectors)
+    keep_all = np.ones(num_planes, dtype=bool)
+    if num_planes < 4:
+        return keep_all
+    vertices = get_polyhedron_vertices(site_point, plane_points, plane_vectors)
+    if vertices is None:
+        return keep_all
+    distances = get_plane_distances(vertices, plane_points, plane_vectors)
+    keep = distances.max(axis=1) >= -(margin + tol)
+
+    # verify that the removed planes were really not needed
+    if np.all(keep):
+        return keep
+    plane_points = np.asarray(plane_points, dtype=np.float64).reshape(-1, 3)
+    plane_vectors = np.asarray(plane_vectors, dtype=np.float64).reshape(-1, 3)
+    pruned_vertices = get_polyhedron_vertices(
+        site_point, plane_points[keep], plane_vectors[keep]
+    )
+    if pruned_vertices is None:
+        return keep_all
+    removed_distances = get_plane_distances(
+        pruned_vertices, plane_points[~keep], plane_vectors[~keep]
+    )
+    if np.any(removed_distances > tol):
+        return keep_all
+    return keep
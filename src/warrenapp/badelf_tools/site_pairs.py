@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+from scipy.spatial import cKDTree
+from simmate.toolkit import Structure
+
+from warrenapp.badelf_tools.lattice import Lattice
+
+###############################################################################
+# This module defines functions for finding which site-neighbor pairs give the
+# same partitioning plane, so that the ELF line between them only needs to be
+# searched once.
+#
+# A pair is described by the index of its site and the fractional vector from
+# the site to the neighbor. A symmetry operation with rotation W (in fractional
+# coordinates) moves the pair (i, d) to the pair (i', W @ d), where i' is the
+# site that i is moved onto. The translation of the operation cancels out of d.
+#
+# Every pair (i, j, d) from site i to neighbor j also has a reciprocal pair
+# (j, i, -d) in the neighbor list of site j. Both lie on the same line through
+# the same points of the grid, just walked in the opposite direction. The
+# reciprocal pair's minimum is the same point with the fraction along the line
+# flipped, so only one of the two lines needs to be searched.
+###############################################################################
+
+
+def get_structure_from_lattice(lattice: Lattice):
+    """
+    Builds a Structure from the lattice, species and atom positions in the
+    header of the partitioning file
+    """
+    species = []
+    for element, element_num in zip(lattice.elements, lattice.elements_num):
+        species.extend([element] * element_num)
+    return Structure(lattice.matrix, species, lattice.coords)
+
+
+def get_symmetry_site_mapping(structure: Structure, operations: list, tol: float):
+    """
+    Gets the site that each site is moved onto by each symmetry operation.
+    Returns an array with shape (operations, sites).
+    """
+    frac_coords = structure.frac_coords
+    site_mapping = []
+    for operation in operations:
+        new_coords = operation.operate_multi(frac_coords)
+        # get the shortest vector between every moved site and every site
+        differences = new_coords[:, np.newaxis, :] - frac_coords[np.newaxis, :, :]
+        differences -= np.round(differences)
+        distances = np.linalg.norm(differences @ structure.lattice.matrix, axis=2)
+        mapping = np.argmin(distances, axis=1)
+        if np.any(distances[np.arange(len(mapping)), mapping] > tol):
+            raise ValueError(
+                "A symmetry operation of the structure does not map the atoms "
+                "onto each other. Try a larger symprec."
+            )
+        site_mapping.append(mapping)
+    return np.array(site_mapping)
+
+
+def get_symmetry_equivalent_pairs(
+    lattice: Lattice,
+    pair_sites: np.ndarray,
+    pair_vectors: np.ndarray,
+    symprec: float = 0.01,
+):
+    """
+    Finds the site-neighbor pairs that are equivalent by the symmetry of the
+    structure. pair_sites holds the site index of each pair and pair_vectors
+    the fractional vector from the site to its neighbor.
+
+    Returns an array with the index of a representative pair for each pair.
+    Equivalent pairs share the same representative, which is always the
+    equivalent pair with the lowest index. Pairs whose equivalents are not in
+    the list are their own representative.
+    """
+    structure = get_structure_from_lattice(lattice)
+    operations = SpacegroupAnalyzer(
+        structure, symprec=symprec
+    ).get_symmetry_operations()
+    site_mapping = get_symmetry_site_mapping(structure, operations, tol=symprec * 10)
+
+    pair_sites = np.asarray(pair_sites, dtype=int)
+    pair_vectors = np.asarray(pair_vectors, dtype=np.float64).reshape(-1, 3)
+    num_pairs = len(pair_sites)
+    # We look pairs up by their site and cartesian vector. Separating the
+    # sites by a large distance lets us search both at once with one tree.
+    site_spacing = 1e4
+    pair_keys = np.column_stack(
+        [pair_sites * site_spacing, pair_vectors @ lattice.matrix]
+    )
+    tree = cKDTree(pair_keys)
+
+    representatives = np.arange(num_pairs)
+    for operation, mapping in zip(operations, site_mapping):
+        new_vectors = pair_vectors @ operation.rotation_matrix.T
+        new_keys = np.column_stack(
+            [mapping[pair_sites] * site_spacing, new_vectors @ lattice.matrix]
+        )
+        distances, matches = tree.query(new_keys, distance_upper_bound=symprec)
+        # pairs moved onto a pair that isn't in our list are not found and are
+        # given the index num_pairs by the tree
+        found = matches < num_pairs
+        representatives[found] = np.minimum(representatives[found], matches[found])
+    # The operations form a group, so every pair in a set of equivalent pairs
+    # finds the same set of matches and the same lowest index.
+    return representatives
+
+
+def get_reciprocal_pairs(
+    lattice: Lattice,
+    pair_sites: np.ndarray,
+    pair_neigh_sites: np.ndarray,
+    pair_vectors: np.ndarray,
+    tol: float = 1e-3,
+):
+    """
+    Finds the reciprocal of each site-neighbor pair, i.e. the pair going from
+    the neighbor back to the site. pair_neigh_sites holds the site index of
+    each neighbor and tol is the largest allowed difference between the bond
+    vectors in Angstrom.
+
+    Returns an array with the index of the reciprocal of each pair, or -1 if
+    the reciprocal isn't in the list (e.g. it is past the last neighbor kept
+    for the other site).
+    """
+    pair_sites = np.asarray(pair_sites, dtype=int)
+    pair_neigh_sites = np.asarray(pair_neigh_sites, dtype=int)
+    pair_vectors = np.asarray(pair_vectors, dtype=np.float64).reshape(-1, 3)
+    num_pairs = len(pair_sites)
+    # use the same kind of keys as get_symmetry_equivalent_pairs
+    site_spacing = 1e4
+    tree = cKDTree(
+        np.column_stack([pair_sites * site_spacing, pair_vectors @ lattice.matrix])
+    )
+    reciprocal_keys = np.column_stack(
+        [pair_neigh_sites * site_spacing, -pair_vectors @ lattice.matrix]
+    )
+    distances, matches = tree.query(reciprocal_keys, distance_upper_bound=tol)
+    return np.where(matches < num_pairs, matches, -1)
+
+
+def get_pair_representatives(
+    lattice: Lattice,
+    pair_sites: np.ndarray,
+    pair_neigh_sites: np.ndarray,
+    pair_vectors: np.ndarray,
+    use_symmetry: bool = False,
+    symprec: float = 0.01,
+):
+    """
+    Finds a representative pair for each site-neighbor pair. The ELF line
+    only needs to be searched for the representatives and the results can be
+    copied to the other pairs.
+
+    Returns two arrays. The first holds the index of the representative of
+    each pair. The second is True for pairs that are the reciprocal of their
+    representative (or of a pair equivalent to it), so that their ELF line
+    runs in the opposite direction. If use_symmetry is True, pairs that are
+    equivalent by symmetry also share a representative (see
+    get_symmetry_equivalent_pairs).
+    """
+    if use_symmetry:
+        representatives = get_symmetry_equivalent_pairs(
+            lattice, pair_sites, pair_vectors, symprec=symprec
+        )
+    else:
+        representatives = np.arange(len(pair_sites))
+    reciprocals = get_reciprocal_pairs(
+        lattice, pair_sites, pair_neigh_sites, pair_vectors
+    )
+    # The reciprocals of a set of equivalent pairs are also equivalent to each
+    # other, so every pair in a set finds the same reciprocal representative.
+    # We use whichever of the two has the lower index.
+    reciprocal_representatives = np.where(
+        reciprocals >= 0, representatives[reciprocals], representatives
+    )
+    reversed_pairs = reciprocal_representatives < representatives
+    representatives = np.minimum(representatives, reciprocal_representatives)
+    return representatives, reversed_pairs
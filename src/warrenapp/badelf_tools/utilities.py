@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
 from pymatgen.io.vasp.inputs import Poscar
+from pymatgen.io.vasp.outputs import Chgcar, Elfcar
 from simmate.toolkit import Structure
 
 from warrenapp.badelf_tools.badelf_algorithm_functions import (
@@ -16,14 +19,33 @@ from warrenapp.badelf_tools.badelf_algorithm_functions import (
     get_voxel_from_frac,
     get_voxel_from_neigh_CrystalNN,
 )
+from warrenapp.badelf_tools.interpolation import PeriodicGridInterpolator
+from warrenapp.badelf_tools.lattice import Lattice
+from warrenapp.badelf_tools.volumetric_io import (
+    find_volumetric_file,
+    open_volumetric_file,
+)
+
+# The number of bytes copied at once when writing the _empty density files
+COPY_BLOCK_SIZE = 16 * 1024 * 1024
 
 
-def check_required_files(directory: Path, required_files: list):
+def check_required_files(
+    directory: Path,
+    required_files: list,
+    allow_compressed: bool = False,
+):
     """
     Checks to make sure that all the files in a folder exist. Otherwise raises
-    an error.
+    an error. If allow_compressed is True, a compressed copy of a file (e.g.
+    ELFCAR.gz) also counts. This should only be used when the files are read
+    by warrenapp itself and not by an external program like bader.
     """
-    if not all((directory / file).exists() for file in required_files):
+    if allow_compressed:
+        file_paths = [find_volumetric_file(directory / file) for file in required_files]
+    else:
+        file_paths = [directory / file for file in required_files]
+    if not all(file_path.exists() for file_path in file_paths):
         raise Exception(
             f"""Make sure your `setup` method directory source is defined correctly. 
         The following files must exist in the directory where 
@@ -31,7 +53,7 @@ def check_required_files(directory: Path, required_files: list):
         )
 
 
-def get_badelf_radius(neigh: list, lattice: dict, site_pos: dict, grid):
+def get_badelf_radius(neigh: list, lattice: Lattice, site_pos: dict, grid):
     """
     Function for getting the line, plane, and other information between a site
     and neighbor
@@ -60,7 +82,7 @@ def get_badelf_radius(neigh: list, lattice: dict, site_pos: dict, grid):
     # get the plane perpendicular to the position.
 
     # it is also helpful to know the distance of the minimum from the site
-    radius = sum([(b - a) ** 2 for a, b in zip(real_site_pos, real_vox_pos)]) ** (0.5)
+    radius = np.linalg.norm(real_vox_pos - real_site_pos)
     return radius
 
 
@@ -75,7 +97,8 @@ def get_max_radius(structure: Structure, partition_file: str):
     """
     closest_neighbors = get_closest_neighbors(structure)
     lattice = get_lattice(partition_file)
-    grid = get_partitioning_grid(partition_file, lattice)
+    # interpolate the grid once for every site
+    grid = PeriodicGridInterpolator(get_partitioning_grid(partition_file, lattice))
     site_radii = {}
     element_radii = {}
     # iterate through each site in the structure
@@ -133,7 +156,11 @@ def get_empties_from_bcf(
     required_files = ["ELFCAR", "POSCAR", "BCF.dat"]
 
     # Check that all of the required files are present
-    check_required_files(directory=directory, required_files=required_files)
+    check_required_files(
+        directory=directory,
+        required_files=required_files,
+        allow_compressed=True,
+    )
 
     # We want to compare each ELF maximum to each atom and determine if it is
     # within that atoms "badelf radius" which is the distance between an atom
@@ -274,16 +301,45 @@ def get_electride_num(directory: Path = None, filename: str = "POSCAR_empty"):
     return electride_sites
 
 
+def replace_density_file_header(
+    density_file: Path,
+    new_density_file: Path,
+    structure_lines: list,
+    lines_to_replace: int,
+):
+    """
+    Writes a copy of a CHGCAR or ELFCAR with the structure block in its header
+    replaced. Only the header is read line by line. The rest of the file is
+    copied in large binary blocks starting from the end of the old header, so
+    the grid data is never split into lines or held in memory. A compressed
+    density file is decompressed as it is copied.
+    """
+    with open_volumetric_file(density_file) as file:
+        # Keep the first five lines (comment, scale, and lattice vectors)
+        early_lines_to_keep = [file.readline() for i in range(5)]
+        # skip the rest of the old structure block
+        for i in range(5, lines_to_replace + 1):
+            file.readline()
+        with open(new_density_file, "wb") as new_file:
+            new_file.writelines(early_lines_to_keep)
+            new_file.writelines(structure_lines)
+            shutil.copyfileobj(file, new_file, COPY_BLOCK_SIZE)
+
+
 def write_density_file_empty(
     directory: Path,
     structure: Structure,
     analysis_type: str = "badelf",
+    max_workers: int = None,
 ):
     """
     A function for replacing the structure at the beginning of a CHGCAR or
     ELFCAR file and writing new CHGCAR_empty and ELFCAR_empty files. Structure
     must be the original structure without empty atoms and a POSCAR_empty
     file must already exist in the directory.
+
+    The files are written at the same time on a thread pool. By default there
+    is one thread for each file.
     """
     # Set names of density files based on analysis_type.
     if analysis_type == "badelf":
@@ -294,33 +350,114 @@ def write_density_file_empty(
         density_files = ["CHGCAR", "CHGCAR_sum", "ELFCAR"]
     # Check for required files
     required_files = density_files + ["POSCAR_empty"]
-    check_required_files(directory=directory, required_files=required_files)
+    check_required_files(
+        directory=directory,
+        required_files=required_files,
+        allow_compressed=True,
+    )
     # Get number of lines to replace in teh ELFCAR
     lines_to_replace = structure.num_sites + 8
+    # Copy over the structure file with empties.
+    with open(directory / "POSCAR_empty", "rb") as file:
+        structure_lines = file.readlines()[5:]
     # Run for each file
-    for density_file in density_files:
-        # Open CHGCAR or ELFCAR and add all of the lines past the structure info
-        # to a list.
-        file = open(directory / f"{density_file}", "r")
-        early_lines_to_keep = []
-        later_lines_to_keep = []
-        for i, line in enumerate(file):
-            if i < 5:
-                early_lines_to_keep.append(line)
-            elif i > lines_to_replace:
-                later_lines_to_keep.append(line)
-        file.close()
-        # Copy over the structure file with empties.
-        structure_lines = []
-        with open(directory / "POSCAR_empty") as file:
-            for i, line in enumerate(file):
-                if i > 4:
-                    structure_lines.append(line)
-
-        with open(directory / f"{density_file}_empty", "w") as file:
-            file.writelines(early_lines_to_keep)
-            file.writelines(structure_lines)
-            file.writelines(later_lines_to_keep)
+    with ThreadPoolExecutor(max_workers=max_workers or len(density_files)) as executor:
+        futures = [
+            executor.submit(
+                replace_density_file_header,
+                density_file=directory / density_file,
+                new_density_file=directory / f"{density_file}_empty",
+                structure_lines=structure_lines,
+                lines_to_replace=lines_to_replace,
+            )
+            for density_file in density_files
+        ]
+        # raise any errors from the threads
+        for future in futures:
+            future.result()
+
+
+def write_element_voxel_files(
+    directory: Path,
+    poscar: Poscar,
+    element: str,
+    site_indices: list,
+    site_labels: np.ndarray,
+    charge_grid: np.ndarray,
+    partitioning_grid: np.ndarray,
+):
+    """
+    Writes CHGCAR_{element} and ELFCAR_{element} files that only contain the
+    charge and ELF of the voxels assigned to the given sites. site_labels is
+    an array with the same shape as the grids holding the site each voxel was
+    assigned to (NaN for unassigned voxels).
+    """
+    # find all voxels belonging to this element at once
+    element_voxels = np.isin(site_labels, site_indices)
+    chgcar_data = np.where(element_voxels, charge_grid, 0)
+    elfcar_data = np.where(element_voxels, partitioning_grid, 0)
+    # if "dummy" atom, replace string with e
+    if element == "He":
+        element = "e"
+    # create elfcar and chgcar objects and write to file
+    chgcar = Chgcar(poscar, {"diff": chgcar_data, "total": chgcar_data})
+    elfcar = Elfcar(poscar, {"diff": elfcar_data, "total": elfcar_data})
+    chgcar.write_file(directory / f"CHGCAR_{element}")
+    elfcar.write_file(directory / f"ELFCAR_{element}")
+
+
+def write_atom_voxel_files(
+    directory: Path,
+    poscar: Poscar,
+    site_labels: np.ndarray,
+    charge_grid: np.ndarray,
+    partitioning_grid: np.ndarray,
+    nprocs: int = 1,
+):
+    """
+    Writes a CHGCAR and ELFCAR for each element in the structure containing
+    only the voxels assigned to atoms of that element. Most of the time is
+    spent formatting the text files, so if nprocs is more than 1 the elements
+    are written at the same time in separate processes.
+    """
+    structure = poscar.structure
+    # get list of site indices for each type of atom
+    elements = {
+        element: structure.indices_from_symbol(element)
+        for element in poscar.site_symbols
+    }
+    if nprocs <= 1 or len(elements) <= 1:
+        for element, site_indices in elements.items():
+            write_element_voxel_files(
+                directory,
+                poscar,
+                element,
+                site_indices,
+                site_labels,
+                charge_grid,
+                partitioning_grid,
+            )
+        return
+    # memory maps don't pickle cheaply so we send plain arrays to each process
+    charge_grid = np.asarray(charge_grid)
+    partitioning_grid = np.asarray(partitioning_grid)
+    with ProcessPoolExecutor(max_workers=min(nprocs, len(elements))) as executor:
+        futures = [
+            executor.submit(
+                write_element_voxel_files,
+                directory,
+                poscar,
+                element,
+                site_indices,
+                site_labels,
+                charge_grid,
+                partitioning_grid,
+            )
+            for element, site_indices in elements.items()
+        ]
+        # raise any errors from the processes
+        for future in futures:
+            future.result()
 
 
 def get_density_file_empty(
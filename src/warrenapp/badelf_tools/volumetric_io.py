@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+import bz2
+import gzip
+import io
+import lzma
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from math import prod as product
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pymatgen.io.vasp.inputs import Poscar
+
+from warrenapp.badelf_tools.lattice import Lattice
+
+###############################################################################
+# This module defines functions for reading the grid data from VASP volumetric
+# files (CHGCAR, ELFCAR, BvAt####.dat, etc.). The header of these files is
+# read with get_lattice in badelf_algorithm_functions.py and the Lattice
+# object it returns tells us where the grid starts and how large it is. All of
+# the readers accept compressed files (see open_volumetric_file).
+###############################################################################
+
+# The number of bytes read from a file at once when streaming a grid
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Volumetric files are often archived compressed. We recognize the format from
+# the first bytes of the file rather than its name, and these are the suffixes
+# we look for when the plain file (e.g. ELFCAR) doesn't exist.
+COMPRESSION_MAGIC = {
+    "gzip": b"\x1f\x8b",
+    "bz2": b"BZh",
+    "xz": b"\xfd7zXZ\x00",
+    "zstd": b"\x28\xb5\x2f\xfd",
+}
+COMPRESSED_SUFFIXES = (".gz", ".bz2", ".xz", ".zst")
+
+
+def find_volumetric_file(filename: Path):
+    """
+    Gets the path of a volumetric file, allowing for a compressed copy. If the
+    file doesn't exist but a compressed version does (e.g. ELFCAR.gz), the path
+    to the compressed version is returned. Otherwise the original path is
+    returned unchanged.
+    """
+    filename = Path(filename)
+    if filename.exists():
+        return filename
+    for suffix in COMPRESSED_SUFFIXES:
+        compressed_filename = filename.with_name(filename.name + suffix)
+        if compressed_filename.exists():
+            return compressed_filename
+    return filename
+
+
+def get_compression(filename: Path):
+    """
+    Gets the compression format of a file from its first few bytes. Returns
+    None for uncompressed files.
+    """
+    with open(filename, "rb") as file:
+        start = file.read(6)
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if start.startswith(magic):
+            return compression
+    return None
+
+
+def open_volumetric_file(filename: Path, mode: str = "rb"):
+    """
+    Opens a volumetric file for reading in binary ("rb") or text ("r") mode.
+    gzip, bz2, xz and zstd files are decompressed on the fly as they are read,
+    so no uncompressed copy is ever written to disk. Reading zstd files
+    requires the optional zstandard package.
+    """
+    filename = find_volumetric_file(filename)
+    compression = get_compression(filename)
+    if compression is None:
+        return open(filename, mode)
+    # the compression modules want an explicit text mode
+    if mode == "r":
+        mode = "rt"
+    if compression == "gzip":
+        return gzip.open(filename, mode)
+    elif compression == "bz2":
+        return bz2.open(filename, mode)
+    elif compression == "xz":
+        return lzma.open(filename, mode)
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            f"{filename} is compressed with zstd. Install the zstandard package "
+            "(pip install zstandard) to read it."
+        )
+    file = io.BufferedReader(
+        zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True),
+        buffer_size=CHUNK_SIZE,
+    )
+    if mode == "rt":
+        return io.TextIOWrapper(file)
+    return file
+
+
+def read_volumetric_structure(filename: Path):
+    """
+    Reads only the structure from the header of a VASP volumetric file. The
+    header is the same as a POSCAR so we read lines until the last atom
+    position and stop there, which avoids loading the grid the way
+    Chgcar.from_file does.
+    """
+    header_lines = []
+    num_atoms = None
+    with open_volumetric_file(filename, "r") as file:
+        for i, line in enumerate(file):
+            header_lines.append(line)
+            if i == 6:
+                num_atoms = sum(int(x) for x in line.split())
+            if num_atoms is not None and i == 7 + num_atoms:
+                break
+    if num_atoms is None or len(header_lines) < 8 + num_atoms:
+        raise ValueError(f"{filename} ended before the structure was read")
+    return Poscar.from_str("".join(header_lines)).structure
+
+
+def skip_volumetric_header(file, lattice: Lattice):
+    """
+    Moves an open (binary) volumetric file to the start of its first grid.
+    The header is the POSCAR-like structure block followed by a blank line and
+    the line with the grid size.
+    """
+    for i in range(10 + lattice.num_atoms):
+        if not file.readline():
+            raise ValueError("Volumetric file ended before the grid data started")
+
+
+def get_line_end(text: bytes, line_number: int):
+    """
+    Gets the index just past the end of a given line (1-indexed) in a block
+    of text. Returns the length of the text if it has fewer lines.
+    """
+    newlines = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == ord("\n"))
+    if len(newlines) < line_number:
+        return len(text)
+    return int(newlines[line_number - 1]) + 1
+
+
+def iter_grid_blocks(file, lattice: Lattice, chunk_size: int = CHUNK_SIZE):
+    """
+    Reads the grid section of an open volumetric file in blocks of complete
+    lines. Yields (text, start, count, values_per_line) where start is the
+    index of the first grid value in the block and count is the number of
+    values it holds.
+
+    VASP writes a fixed number of values per line (10 for ELFCAR, 5 for CHGCAR)
+    with a shorter final line. We use the first line to find this number so we
+    know exactly where the grid ends. Anything after it (augmentation
+    occupancies, a second spin grid, etc.) is never returned.
+    """
+    total_values = int(np.prod(lattice.grid_size))
+    filled = 0
+    values_per_line = None
+    remainder = b""
+
+    skip_volumetric_header(file, lattice)
+    while filled < total_values:
+        new_data = file.read(chunk_size)
+        block = remainder + new_data
+        if not block.strip():
+            raise ValueError(
+                f"Volumetric file ended after {filled} of {total_values} grid values"
+            )
+        # Only return complete lines. If we've reached the end of the file
+        # the last line may not have a newline.
+        if new_data:
+            cut = block.rfind(b"\n") + 1
+            if cut == 0:
+                remainder = block
+                continue
+        else:
+            cut = len(block)
+        text, remainder = block[:cut], block[cut:]
+
+        if values_per_line is None:
+            values_per_line = len(text[: get_line_end(text, 1)].split())
+
+        # If this block reaches the end of the grid, cut it at the last
+        # line of grid data
+        lines_needed = ceil((total_values - filled) / values_per_line)
+        text = text[: get_line_end(text, lines_needed)]
+        lines = text.count(b"\n") + (not text.endswith(b"\n"))
+        count = min(lines * values_per_line, total_values - filled)
+
+        yield text, filled, count, values_per_line
+        filled += count
+
+
+def parse_grid_block(text: bytes, count: int):
+    """
+    Parses a block of grid values with numpy's text parser
+    """
+    values = np.fromstring(text, dtype=np.float64, sep=" ")
+    if len(values) != count:
+        raise ValueError(
+            f"Expected {count} grid values in block but found {len(values)}. "
+            "The grid data is not laid out with a fixed number of values per line."
+        )
+    return values
+
+
+def parse_grid_block_threaded(text: bytes, count: int, values_per_line: int):
+    """
+    Parses a block of grid values with pandas' C parser. Unlike numpy's text
+    parser, it releases the GIL while tokenizing and converting floats, so
+    several blocks can be parsed at once on a thread pool. A short final line
+    is filled with NaN which we cut off.
+    """
+    values = pd.read_csv(
+        io.BytesIO(text),
+        sep=r"\s+",
+        header=None,
+        names=range(values_per_line),
+        dtype=np.float64,
+        engine="c",
+    ).to_numpy()
+    values = values.ravel()[:count]
+    if len(values) != count or np.isnan(values).any():
+        raise ValueError(
+            f"Expected {count} grid values in block but could not read them. "
+            "The grid data is not laid out with a fixed number of values per line."
+        )
+    return values
+
+
+def fill_grid_block(grid, text: bytes, start: int, count: int, values_per_line: int):
+    """
+    Parses a block of grid values and writes them into the flat grid
+    """
+    grid[start : start + count] = parse_grid_block_threaded(
+        text, count, values_per_line
+    )
+
+
+def read_volumetric_grid(
+    filename: Path,
+    lattice: Lattice,
+    nthreads: int = 1,
+    chunk_size: int = CHUNK_SIZE,
+):
+    """
+    Reads the first grid of a VASP volumetric file into a 3D numpy array in a
+    single pass. The values are parsed block by block directly into a
+    preallocated array, so the peak memory is roughly one grid.
+
+    If nthreads is more than 1, the blocks are parsed on a thread pool and
+    each thread writes its values straight into its slice of the grid. Only
+    a few blocks are held in memory at once.
+    """
+    grid_size = [int(x) for x in lattice.grid_size]
+    grid = np.empty(product(grid_size), dtype=np.float64)
+
+    with open_volumetric_file(filename) as file:
+        if nthreads > 1:
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                pending = deque()
+                for text, start, count, values_per_line in iter_grid_blocks(
+                    file, lattice, chunk_size
+                ):
+                    pending.append(
+                        executor.submit(
+                            fill_grid_block,
+                            grid,
+                            text,
+                            start,
+                            count,
+                            values_per_line,
+                        )
+                    )
+                    # Limit how many blocks are waiting to be parsed so that
+                    # we don't end up reading the whole file into memory
+                    while len(pending) > 2 * nthreads:
+                        pending.popleft().result()
+                for future in pending:
+                    future.result()
+        else:
+            for text, start, count, values_per_line in iter_grid_blocks(
+                file, lattice, chunk_size
+            ):
+                grid[start : start + count] = parse_grid_block(text, count)
+
+    # VASP writes the grid with the x index changing fastest, which is
+    # Fortran order. Reshaping the flat array this way doesn't copy it.
+    return grid.reshape(grid_size, order="F")
+
+
+def read_nonzero_voxel_indices(
+    filename: Path,
+    lattice: Lattice,
+    threaded_parser: bool = False,
+    chunk_size: int = CHUNK_SIZE,
+):
+    """
+    Reads a volumetric file and returns only the indices of voxels with a
+    nonzero value. This is meant for files like Bader's BvAt####.dat where
+    most of the grid is zero. The file is checked block by block so the full
+    grid is never held in memory.
+
+    The indices are flat indices into the grid in C order (x changes slowest,
+    z fastest), which is the order of itertools.product over the three axes.
+    If threaded_parser is True, pandas' GIL-releasing parser is used so that
+    several files can be read at once on a thread pool.
+    """
+    grid_size = [int(x) for x in lattice.grid_size]
+    nonzero_indices = []
+    with open_volumetric_file(filename) as file:
+        for text, start, count, values_per_line in iter_grid_blocks(
+            file, lattice, chunk_size
+        ):
+            if threaded_parser:
+                values = parse_grid_block_threaded(text, count, values_per_line)
+            else:
+                values = parse_grid_block(text, count)
+            nonzero_indices.append(np.flatnonzero(values) + start)
+    # The file is written in Fortran order so we convert the indices to C order
+    fortran_indices = np.concatenate(nonzero_indices)
+    voxel_indices = np.unravel_index(fortran_indices, grid_size, order="F")
+    return np.sort(np.ravel_multi_index(voxel_indices, grid_size, order="C"))
+
+
+def read_nonzero_voxel_indices_concurrently(
+    filenames: list,
+    lattice: Lattice,
+    nthreads: int = 1,
+):
+    """
+    Runs read_nonzero_voxel_indices on several files at once. Returns a list
+    of index arrays in the same order as the filenames.
+    """
+    if nthreads <= 1 or len(filenames) <= 1:
+        return [read_nonzero_voxel_indices(filename, lattice) for filename in filenames]
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        return list(
+            executor.map(
+                lambda filename: read_nonzero_voxel_indices(
+                    filename, lattice, threaded_parser=True
+                ),
+                filenames,
+            )
+        )
@@ -18,7 +18,7 @@ import pandas
 import pandas as pd
 import psutil
 from dask.distributed import Client, LocalCluster
-from pymatgen.io.vasp import Chgcar, Elfcar, Poscar
+from pymatgen.io.vasp import Poscar
 from simmate.engine import Workflow
 from simmate.toolkit import Structure
 
@@ -27,17 +27,34 @@ from warrenapp.badelf_tools.badelf_algorithm_functions import (
     get_charge_density_grid,
     get_electride_sites,
     get_lattice,
-    get_max_voxel_dist,
     get_number_of_partitions,
     get_partitioning_fine,
     get_partitioning_grid,
     get_partitioning_rough,
+    get_plane_voxel_dists,
     get_real_from_frac,
     get_voxels_site_dask,
     get_voxels_site_multi_plane,
     get_voxels_site_nearest,
     get_voxels_site_volume_ratio_dask,
 )
+from warrenapp.badelf_tools.interpolation import PeriodicGridInterpolator
+from warrenapp.badelf_tools.label_map import (
+    LABEL_MAP_FILENAME,
+    get_voxel_label_map,
+    write_label_map,
+)
+from warrenapp.badelf_tools.plane_cache import (
+    get_plane_cache_filename,
+    get_plane_cache_key,
+    read_plane_cache,
+    write_plane_cache,
+)
+from warrenapp.badelf_tools.plane_table import PlaneTable
+from warrenapp.badelf_tools.utilities import write_atom_voxel_files
+from warrenapp.badelf_tools.volumetric_io import (
+    read_nonzero_voxel_indices_concurrently,
+)
 from warrenapp.models import WarrenPopulationAnalysis
 
 ###############################################################################
@@ -59,9 +76,18 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
         empty_partition_file: str = "ELFCAR_empty",
         charge_file: str = "CHGCAR",
         print_atom_voxels: bool = False,
+        use_grid_cache: bool = True,
+        save_label_map: bool = False,
+        use_symmetry: bool = False,
+        refine_tolerance: float = 0.01,
+        use_plane_cache: bool = True,
+        element_radii: dict = None,
         **kwargs,
     ):
         t0 = time.time()
+        # Get the total number of cpus available. These are used for parsing
+        # the grid files here and by the dask cluster later.
+        cpu_count = math.floor(len(psutil.Process().cpu_affinity()) / 2)
         structure = Structure.from_file(directory / structure_file)
         # get dictionary of sites and closest neighbors. This always throws
         # the same warning about He's EN so we suppress that here
@@ -84,49 +110,98 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
 
         # we'll need the volume of each voxel later to calculate the atomic
         # volumes for our output file
-        voxel_volume = lattice["volume"] / np.prod(lattice["grid_size"])
+        voxel_volume = lattice.voxel_volume
 
         # we also want the voxel resolution
-        voxel_resolution = np.prod(lattice["grid_size"]) / lattice["volume"]
+        voxel_resolution = np.prod(lattice.grid_size) / lattice.volume
         print(voxel_resolution)
 
         # read in partition grid
         if partition_file == "ELFCAR":
             grid = get_partitioning_grid(
-                partition_file=directory / partition_file, lattice=lattice
+                partition_file=directory / partition_file,
+                lattice=lattice,
+                use_cache=use_grid_cache,
+                nthreads=cpu_count,
             )
         elif partition_file == "CHGCAR":
             grid = get_charge_density_grid(
-                charge_file=directory / partition_file, lattice=lattice
+                charge_file=directory / partition_file,
+                lattice=lattice,
+                use_cache=use_grid_cache,
+                nthreads=cpu_count,
             )
 
-        # The algorithm now looks at each site-neighbor pair.
-        # Along the bond between the pair, we look at ELF values.
-        # We find the position of the minimum ELF value.
-        # We then find the plane that passes through this minimum and
-        # that is perpendicular to the bond between the pair.
-
-        if voxel_resolution > 130000:
-            results = get_partitioning_rough(
-                neighbors26=neighbors26,
-                lattice=lattice,
-                grid=grid,
-                rough_partitioning=True,
+        # The planes only depend on the partitioning grid, the structure and
+        # the settings below. If they've been found for the same inputs before
+        # we load them from the plane cache next to the partitioning file.
+        # Every setting that moves the planes belongs here, even the ones we
+        # leave at their defaults, so that they are part of the cache key.
+        partitioning_settings = dict(
+            use_symmetry=use_symmetry,
+            symprec=0.01,
+            prune_planes=True,
+            refine_tolerance=refine_tolerance,
+            points_per_voxel=5,
+            element_radii=element_radii,
+            radius_window=0.1,
+        )
+        # The key hashes the whole grid, so it is only made if the cache is
+        # used.
+        plane_table = None
+        if use_plane_cache:
+            plane_cache_file = get_plane_cache_filename(directory / partition_file)
+            plane_cache_key = get_plane_cache_key(
+                grid, structure, **partitioning_settings
             )
+            plane_table = read_plane_cache(plane_cache_file, plane_cache_key)
+
+        if plane_table is not None:
+            print(f"Loaded partitioning planes from {plane_cache_file}")
         else:
+            # The interpolation of the grid is set up once and shared by the
+            # rough and fine partitioning
+            grid_interpolator = PeriodicGridInterpolator(grid)
+
+            # The algorithm now looks at each site-neighbor pair.
+            # Along the bond between the pair, we look at ELF values.
+            # We find the position of the minimum ELF value.
+            # We then find the plane that passes through this minimum and
+            # that is perpendicular to the bond between the pair.
+
+            # Rather than choosing between rough and fine partitioning for the
+            # whole grid, the rough pass decides for each pair whether its
+            # minimum is already within refine_tolerance of where the fine
+            # search would put it. Only the other pairs are searched again.
+            # If element_radii is given (e.g. from get_max_radius), each line
+            # is first only searched near where these radii put its minimum.
             rough_partition_results = get_partitioning_rough(
                 neighbors26=neighbors26,
                 lattice=lattice,
-                grid=grid,
+                grid=grid_interpolator,
+                **partitioning_settings,
+            )
+            results = get_partitioning_fine(
+                rough_partition_results,
+                grid_interpolator,
+                lattice,
+                nprocs=cpu_count,
             )
-            results = get_partitioning_fine(rough_partition_results, grid, lattice)
+            # The voxel searches only need the plane of each site-neighbor
+            # pair, so we send the dask workers these as one compact table
+            # rather than the whole results dictionary.
+            plane_table = PlaneTable.from_results(results)
+            if use_plane_cache:
+                write_plane_cache(plane_cache_file, plane_cache_key, plane_table)
         t1 = time.time()
 
         print(f"Partitioning Time: {t1-t0}")
         # We will also need to find the maximum distance the center of a voxel
         # can be from a plane and still be intersected by it. That way we can
-        # handle voxels near partitioning planes with more accuracy
-        max_voxel_dist = get_max_voxel_dist(lattice)
+        # handle voxels near partitioning planes with more accuracy. This
+        # depends on the direction of the plane, so we find it for each plane
+        # in the table.
+        max_voxel_dist = get_plane_voxel_dists(plane_table.planes["normal"], lattice)
 
         # Now that we've identified the planes that divide the ELF, we now need to
         # actually apply that knowledge, voxel by voxel.
@@ -159,16 +234,14 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
         results_min_dist = {}
         results_volume = {}
         # fill site coords dictionary
-        for site, site_coord in enumerate(empty_lattice["coords"]):
+        for site, site_coord in enumerate(empty_lattice.coords):
             results_coords[site] = get_real_from_frac(
                 frac_pos=site_coord, lattice=lattice
             )
             # fill min_dist dictionary using the smallest partitioning radius
             if site not in electride_sites:
-                radii = []
-                for neighbor in results[site].values():
-                    radii.append(neighbor["radius"])
-                min_radii = min(radii)
+                radii = plane_table.get_site_planes(site)["radius"]
+                min_radii = float(min(radii))
                 results_min_dist[site] = min_radii
             elif site in electride_sites:
                 results_min_dist[site] = 0
@@ -181,13 +254,15 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
         chg = get_charge_density_grid(
             charge_file=directory / charge_file,
             lattice=lattice,
+            use_cache=use_grid_cache,
+            nthreads=cpu_count,
         )
 
         # We need to get the charge on each electride site and get the coordinates that
         # belong to the electride. We first get a dataframe that indexes all of the
         # coordinates. We'll remove the electride coordinates from this later.
 
-        a, b, c = lattice["grid_size"]
+        a, b, c = lattice.grid_size
 
         # Create lists that contain the coordinates of each voxel and their charges
 
@@ -204,22 +279,19 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
         all_charge_coords["chg"] = voxel_charges
         all_charge_coords["site"] = None
         #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        # Now iterate through the charge density coordinates for each electride
-        for electride in electride_sites:
-            # Pull in electride charge density from bader output file (BvAt####.dat format)
-            electride_chg = get_charge_density_grid(
-                charge_file=directory / f"BvAt{str(electride+1).zfill(4)}.dat",
-                lattice=empty_lattice,
-            )
-            electride_indices = []
-            # For each voxel, check if the electride charge density file has any
-            # charge. If it does add its index to the electride_indices list
-            for count, idx in enumerate(voxel_coords):
-                charge_density = float(electride_chg[idx[0], idx[1], idx[2]])
-                if charge_density != 0:
-                    # get indices of electride sites
-                    electride_indices.append(count)
-                    # results_charge[electride] += charge_density
+        # Pull in the voxels that belong to each electride from the bader output
+        # files (BvAt####.dat format). We only need to know which voxels have
+        # any charge, so we read just their indices and do several files at once.
+        electride_files = [
+            directory / f"BvAt{str(electride+1).zfill(4)}.dat"
+            for electride in electride_sites
+        ]
+        all_electride_indices = read_nonzero_voxel_indices_concurrently(
+            filenames=electride_files,
+            lattice=empty_lattice,
+            nthreads=cpu_count,
+        )
+        for electride, electride_indices in zip(electride_sites, all_electride_indices):
             # add electride site to "site" column for every electride indice
             all_charge_coords.iloc[electride_indices, 4] = electride
 
@@ -249,8 +321,7 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
         # For smaller systems (<128,000) it was still benefitial to parallelize
         # though less efficient
 
-        # Get the total number of cpus available and memory available
-        cpu_count = math.floor(len(psutil.Process().cpu_affinity()) / 2)
+        # Get the total memory available
         memory_gb = psutil.virtual_memory()[1] / (1e9)
         # Each worker needs at least 2GB of memory. We select either the number
         # of workers that could have at least this much memory or the number
@@ -275,7 +346,7 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
             # site search for all voxel positions.
             ddf["site"] = ddf.map_partitions(
                 get_voxels_site_dask,
-                results=results,
+                results=plane_table,
                 permutations=permutations,
                 lattice=lattice,
                 electride_sites=electride_sites,
@@ -302,7 +373,7 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
             # as a file with a csv format.
             # if multi_site_same_trans != 0 or multi_site_trans != 0:
             #     with open(directory / "same_site_voxel_count.txt", "w") as file:
-            #         file.write(f"{np.prod(lattice['grid_size'])}\n{multi_site_same_trans}\n{multi_site_trans}")
+            #         file.write(f"{np.prod(lattice.grid_size)}\n{multi_site_same_trans}\n{multi_site_trans}")
             # Replace all instances with numpy nan object so that the rest of the
             # alg doesn't break.
             pdf["site"].replace([-1, -2], np.nan, inplace=True)
@@ -348,7 +419,7 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
             near_plane_ddf["site"] = near_plane_ddf.map_partitions(
                 get_voxels_site_volume_ratio_dask,
                 lattice=lattice,
-                results=results,
+                results=plane_table,
                 permutations=permutations,
                 voxel_volume=voxel_volume,
             )
@@ -409,7 +480,7 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
                     near_plane_pdf=near_plane_pdf,
                     lattice=lattice,
                     electride_sites=electride_sites,
-                    results=results,
+                    results=plane_table,
                 ),
                 axis=1,
             )
@@ -442,7 +513,7 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
             columns=["sites"]
         )
         if len(missing_voxel_pdf) > 0:
-            perc_voxels = (len(missing_voxel_pdf) / np.prod(lattice["grid_size"])) * 100
+            perc_voxels = (len(missing_voxel_pdf) / np.prod(lattice.grid_size)) * 100
             print(
                 f"""{perc_voxels}% of voxels could not be assigned by base
             algorithm. Remaining voxels will be assigned by closest atom
@@ -478,6 +549,34 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
         else:
             print("All voxels assigned.")
 
+        #######################################################################
+        # Save voxel label map
+        #######################################################################
+        # This stores the site of every voxel and the fractions of voxels split
+        # between sites, so that the partition can be reused later without
+        # running the algorithm again (see label_map.py)
+        if save_label_map:
+            voxel_site_fractions = [near_plane_pdf["site"]]
+            if "sites" in multi_plane_pdf.columns:
+                voxel_site_fractions.append(multi_plane_pdf["sites"])
+            if "sites" in missing_voxel_pdf.columns:
+                voxel_site_fractions.append(missing_voxel_pdf["sites"])
+            label_map = get_voxel_label_map(
+                grid_size=lattice.grid_size,
+                num_sites=empty_lattice.num_atoms,
+                site_labels=pdf["site"],
+                voxel_site_fractions=voxel_site_fractions,
+            )
+            try:
+                label_structure = Structure.from_file(directory / "POSCAR_empty")
+            except:
+                label_structure = structure
+            write_label_map(
+                filename=directory / LABEL_MAP_FILENAME,
+                label_map=label_map,
+                structure=label_structure,
+            )
+
         # divide charge by volume to get true charge
         # this is a vasp convention
         for site, charge in results_charge.items():
@@ -499,7 +598,7 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
         # plane.
         with open(directory / "same_site_voxel_count.txt", "w") as file:
             file.write(
-                f"{structure.formula},{structure.get_space_group_info()[0]},{str(directory.absolute())},{np.prod(lattice['grid_size'])},{multi_site_same_trans},{multi_site_trans},{vert_multi_site_same_trans},{vert_multi_site},{multi_site_no_plane}"
+                f"{structure.formula},{structure.get_space_group_info()[0]},{str(directory.absolute())},{np.prod(lattice.grid_size)},{multi_site_same_trans},{multi_site_trans},{vert_multi_site_same_trans},{vert_multi_site},{multi_site_no_plane}"
             )
         #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
@@ -513,33 +612,22 @@ class PopulationAnalysis__Warren__BadelfIonicRadii(Workflow):
             except:
                 poscar = Poscar(structure)
 
-            # iterate over each element in the empty lattice
-            for element in empty_lattice["elements"]:
-                # get list of site indices for each type of atom
-                site_indices = structure.indices_from_symbol(element)
-                # if "dummy" atom, replace string with e
-                if element == "He":
-                    element = "e"
-                # create an empty numpy array for the chgcar and elfcar
-                chgcar_data = np.zeros(lattice["grid_size"])
-                elfcar_data = np.zeros(lattice["grid_size"])
-                # iterate over all voxels and assign elf and charge values
-                # to numpy arrays
-                for row in all_charge_coords.iterrows():
-                    if row[1]["site"] in site_indices:
-                        x = int(row[1]["x"] - 1)
-                        y = int(row[1]["y"] - 1)
-                        z = int(row[1]["z"] - 1)
-                        chgcar_data[x][y][z] = row[1]["chg"]
-                        elfcar_data[x][y][z] = grid[x][y][z]
-
-                # create elfcar and chgcar objects and write to file
-                chgcar_data = {"diff": chgcar_data, "total": chgcar_data}
-                elfcar_data = {"diff": elfcar_data, "total": elfcar_data}
-                chgcar = Chgcar(poscar, chgcar_data)
-                elfcar = Elfcar(poscar, elfcar_data)
-                chgcar.write_file(f"CHGCAR_{element}")
-                elfcar.write_file(f"ELFCAR_{element}")
+            # The rows of all_charge_coords follow the grid in C order, so the
+            # site column can be reshaped directly into a grid of site labels.
+            # Voxels without a site become NaN.
+            site_labels = (
+                pd.to_numeric(all_charge_coords["site"], errors="coerce")
+                .to_numpy(dtype=np.float64)
+                .reshape(lattice.grid_size)
+            )
+            write_atom_voxel_files(
+                directory=directory,
+                poscar=poscar,
+                site_labels=site_labels,
+                charge_grid=chg,
+                partitioning_grid=grid,
+                nprocs=cpu_count,
+            )
         ###############################################################################
         # Save information into ACF.dat like file
         ###############################################################################